@@ -0,0 +1,251 @@
+from pathlib import Path
+
+import numpy as np
+
+import Background
+import ROILoader
+
+
+CENTER_METHODS = ("centroid", "weighted", "max")
+ROI_SHAPES = ("ellipse", "rectangle")
+# Number of pixels regionProps reduces in a single bincount
+MOMENT_CHUNK_PIXELS = 1 << 20
+
+
+def thresholdLabels(plane, threshold="otsu"):
+    """
+    Labels the connected regions of a plane above a threshold.
+    Input:
+        - plane -> 2D image
+        - threshold -> Intensity threshold, or "otsu" to compute it with Background.otsuThreshold
+    Output:
+        - (Y, X) int label image, 0 is background
+    """
+    from scipy import ndimage
+
+    if threshold == "otsu":
+        threshold = Background.otsuThreshold(plane)
+    labels, count = ndimage.label(plane > float(threshold))
+    return labels
+
+
+def regionProps(labels, intensity=None):
+    """
+    Properties of every labelled region, computed for all regions at once with grouped reductions
+    (bincount over the label image) instead of looping over the regions. The label image is reduced in bands of
+    rows, with coordinates relative to each region's bounding box, so no full image coordinate arrays are built.
+    Input:
+        - labels -> (Y, X) int label image, 0 is background
+        - intensity -> Optional (Y, X) image, needed for the weighted centroid and the max intensity point
+    Output: Dictionary of arrays with one entry per region
+        - label -> Label of the region
+        - area -> Number of pixels
+        - centroid -> (N, 2) mean (Y, X) of the region's pixels
+        - covariance -> (N, 3) central second moments (yy, xx, yx)
+        - bbox -> (N, 4) (ymin, ymax, xmin, xmax) with exclusive maxima
+        - weightedCentroid -> (N, 2) intensity weighted centroid (only with intensity)
+        - maxPoint -> (N, 2) (Y, X) of the brightest pixel (only with intensity)
+    """
+    from scipy import ndimage
+
+    labels = np.asarray(labels)
+    if labels.dtype.kind not in "ui":
+        labels = labels.astype(np.int64)
+    rows, cols = labels.shape
+
+    objects = ndimage.find_objects(labels)
+    ids = np.array([i + 1 for i, region in enumerate(objects) if region is not None], dtype=np.int64)
+    bbox = np.array([(objects[i - 1][0].start, objects[i - 1][0].stop, objects[i - 1][1].start, objects[i - 1][1].stop)
+                     for i in ids], dtype=np.int64).reshape(-1, 4)
+
+    # Corner of every label's bounding box, indexed by label
+    length = ids[-1] + 1 if len(ids) else 1
+    originY = np.zeros(length, dtype=np.int64)
+    originX = np.zeros(length, dtype=np.int64)
+    originY[ids] = bbox[:, 0]
+    originX[ids] = bbox[:, 2]
+
+    names = ["y", "x", "yy", "xx", "yx"]
+    if intensity is not None:
+        intensity = np.asarray(intensity)
+        names += ["w", "wy", "wx"]
+        maxValue = np.full(len(ids), -np.inf)
+        maxPoint = np.zeros((len(ids), 2), dtype=np.float64)
+    totals = {name: np.zeros(length, dtype=np.float64) for name in names}
+    area = np.zeros(length, dtype=np.int64)
+
+    band = max(1, MOMENT_CHUNK_PIXELS // max(cols, 1))
+    for start in range(0, rows, band):
+        block = labels[start:start + band]
+        flat = block.ravel()
+        counts = np.bincount(flat, minlength=length)[:length]
+        area += counts
+        y = (np.arange(start, start + len(block))[:, None] - originY[block]).ravel().astype(np.float64)
+        x = (np.arange(cols)[None, :] - originX[block]).ravel().astype(np.float64)
+        weights = {"y": y, "x": x, "yy": y * y, "xx": x * x, "yx": y * x}
+        if intensity is not None:
+            values = intensity[start:start + band]
+            w = values.ravel().astype(np.float64)
+            weights.update({"w": w, "wy": w * y, "wx": w * x})
+            # Brightest pixel of each region in this band, earlier bands win ties
+            present = np.flatnonzero(counts[ids])
+            if len(present) != 0:
+                positions = np.array(ndimage.maximum_position(values, block, ids[present]), dtype=np.int64).reshape(-1, 2)
+                brightest = values[positions[:, 0], positions[:, 1]]
+                better = brightest > maxValue[present]
+                maxValue[present[better]] = brightest[better]
+                maxPoint[present[better]] = positions[better] + [start, 0]
+        for name in names:
+            totals[name] += np.bincount(flat, weights=weights[name], minlength=length)[:length]
+
+    area = area[ids]
+    sums = {name: values[ids] for name, values in totals.items()}
+    meanY = sums["y"] / area
+    meanX = sums["x"] / area
+    centroid = np.column_stack([bbox[:, 0] + meanY, bbox[:, 2] + meanX])
+    covariance = np.column_stack([sums["yy"] / area - meanY ** 2,
+                                  sums["xx"] / area - meanX ** 2,
+                                  sums["yx"] / area - meanY * meanX])
+
+    props = {"label": ids, "area": area, "centroid": centroid, "covariance": covariance, "bbox": bbox}
+
+    if intensity is not None:
+        total = sums["w"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weighted = np.column_stack([bbox[:, 0] + sums["wy"] / total, bbox[:, 2] + sums["wx"] / total])
+        # Regions without any intensity fall back to their centroid
+        props["weightedCentroid"] = np.where(total[:, None] > 0, weighted, centroid)
+        props["maxPoint"] = maxPoint
+
+    return props
+
+
+def ellipseCorners(centroid, covariance):
+    """
+    Corners of the bounding box of each region's equivalent ellipse (the ellipse with the same second
+    moments), in the layout Napari uses for ellipses.
+    Input: (N, 2) centroids and (N, 3) covariances from regionProps
+    Output: (N, 4, 2) array of (Y, X) corners
+    """
+    yy, xx, yx = covariance.T
+    # Eigenvalues and major axis of each 2x2 covariance matrix
+    mean = (yy + xx) / 2
+    spread = np.sqrt(((yy - xx) / 2) ** 2 + yx ** 2)
+    angle = np.arctan2(2 * yx, yy - xx) / 2
+    # Semi axes of 2 standard deviations, at least one pixel so single pixel regions get a mask
+    major = np.maximum(2 * np.sqrt(mean + spread), 1.0)
+    minor = np.maximum(2 * np.sqrt(np.maximum(mean - spread, 0)), 1.0)
+
+    axisA = np.column_stack([np.cos(angle), np.sin(angle)]) * major[:, None]
+    axisB = np.column_stack([-np.sin(angle), np.cos(angle)]) * minor[:, None]
+    signs = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float64)
+    return (centroid[:, None, :] + signs[None, :, 0, None] * axisA[:, None, :]
+            + signs[None, :, 1, None] * axisB[:, None, :])
+
+
+def rectangleCorners(bbox):
+    """
+    Corners of each region's bounding box, (N, 4, 2) array of (Y, X) corners around the region's pixels.
+    """
+    # Crops end before the largest vertex (see ROIMasks.cropBounds), so the exclusive maxima are the corners
+    ymin, ymax, xmin, xmax = bbox.T.astype(np.float64)
+    return np.stack([np.column_stack([ymin, xmin]), np.column_stack([ymin, xmax]),
+                     np.column_stack([ymax, xmax]), np.column_stack([ymax, xmin])], axis=1)
+
+
+def propsToROIs(props, center="centroid", shape="ellipse", z=None):
+    """
+    Builds an ROI for every region of regionProps.
+    Input:
+        - props -> Output of regionProps
+        - center -> "centroid", "weighted" (intensity weighted centroid) or "max" (brightest pixel). Centers
+                    outside of the ROI's bounding box are moved onto its closest pixel.
+        - shape -> "ellipse" (equivalent ellipse of the region) or "rectangle" (bounding box)
+        - z -> Z-Plane of the ROIs
+    Output:
+        - List of ROI objects, in label order
+    """
+    if center not in CENTER_METHODS:
+        raise ValueError("Unknown center method: " + str(center))
+    if shape not in ROI_SHAPES:
+        raise ValueError("Unknown ROI shape: " + str(shape))
+
+    centers = {"centroid": "centroid", "weighted": "weightedCentroid", "max": "maxPoint"}[center]
+    if centers not in props:
+        raise ValueError("The " + center + " center needs an intensity image")
+
+    if shape == "ellipse":
+        corners = ellipseCorners(props["centroid"], props["covariance"])
+    else:
+        corners = rectangleCorners(props["bbox"])
+
+    # The brightest pixel can lie outside a region's ellipse, crops end before the largest vertex
+    # (see ROIMasks.cropBounds), so every center is clamped into the pixels of its ROI's crop
+    lower = np.trunc(corners.min(axis=1))
+    upper = np.maximum(np.trunc(corners.max(axis=1)) - 1, lower)
+    roiCenters = props[centers]
+    pixel = np.trunc(roiCenters)
+    roiCenters = np.where((pixel < lower) | (pixel > upper), np.clip(roiCenters, lower, upper), roiCenters)
+
+    return [ROILoader.ROI(vertices, shape, roiCenter, z) for vertices, roiCenter in zip(corners, roiCenters)]
+
+
+class ROIGenerator:
+    """
+    Derives ROIs and their centers automatically instead of loading them from a file.
+    Regions come from a label image or, if none is given, from thresholding the segmentation channel.
+    Inputs:
+        - channel -> Name of the channel that is thresholded and used for the weighted and max centers
+        - labelPath -> Optional label image (0 is background). Either a single TIFF used for every scene,
+                       or a folder holding <sceneName>.tif for each scene.
+        - threshold -> Threshold of the segmentation channel, or "otsu"
+        - center -> Center of each ROI, see propsToROIs
+        - shape -> Shape of each ROI, see propsToROIs
+        - minArea -> Regions with fewer pixels are ignored
+        - z -> Z-Plane that is segmented and profiled (ignored when projecting)
+    """
+
+    def __init__(self, channel, labelPath=None, threshold="otsu", center="centroid", shape="ellipse", minArea=1, z=0):
+        self.channel = channel
+        self.labelPath = None if labelPath is None else Path(labelPath)
+        self.threshold = threshold
+        self.center = center
+        self.shape = shape
+        self.minArea = minArea
+        self.z = z
+
+    def labels(self, sceneName, plane):
+        if self.labelPath is None:
+            return thresholdLabels(plane, self.threshold)
+
+        path = self.labelPath
+        if path.is_dir():
+            matches = [path / Path(sceneName + suffix) for suffix in (".tif", ".tiff")]
+            matches = [match for match in matches if match.exists()]
+            if len(matches) == 0:
+                raise FileNotFoundError("No label image for " + sceneName + " in " + str(path))
+            path = matches[0]
+        import tifffile
+
+        labels = np.squeeze(tifffile.imread(path))
+        if labels.shape != plane.shape:
+            raise ValueError("Label image shape " + str(labels.shape) + " does not match the image " + str(plane.shape))
+        return labels
+
+    def generate(self, reader, sceneName, channels):
+        """
+        ROIs of the scene read by reader.
+        Input:
+            - reader -> ImageAccess.SceneReader of the scene
+            - sceneName -> Scene folder name, used to find per scene label images
+            - channels -> Channel names of the image
+        Output:
+            - List of ROI objects
+        """
+        z = None if reader.maxIntensity else self.z
+        plane = reader.plane([channels.index(self.channel)], z)[0]
+        props = regionProps(self.labels(sceneName, plane), plane)
+
+        keep = props["area"] >= self.minArea
+        props = {name: values[keep] for name, values in props.items()}
+        return propsToROIs(props, self.center, self.shape, z)
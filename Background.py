@@ -0,0 +1,149 @@
+import numpy as np
+
+
+METHODS = ("gaussian", "mad", "mode")
+
+# Number of histogram bins used for images that are not 8 or 16 bit integers
+HISTOGRAM_BINS = 4096
+
+
+def samplePlane(plane, step=1, size=None, seed=0):
+    """
+    Pixels of a plane used to estimate its background.
+    Input:
+        - plane -> 2D image
+        - step -> Only every step-th row and column is used. This is a view, nothing is copied.
+        - size -> If given, a reproducible random sample of this many pixels is drawn instead
+        - seed -> Seed of the random sample
+    Output:
+        - Array of sampled pixels (a view of the plane if possible)
+    """
+    if size is not None and size < plane.size:
+        rng = np.random.default_rng(seed)
+        return plane.reshape(-1)[rng.choice(plane.size, size=int(size), replace=False)]
+    if step > 1:
+        return plane[::step, ::step]
+    return plane
+
+
+def histogram(values):
+    """
+    Histogram of the values in a single pass.
+    8 and 16 bit integer images are counted with bincount and, if they span more than HISTOGRAM_BINS
+    values, grouped into bins of equal integer width. Other images are binned into HISTOGRAM_BINS bins
+    between their minimum and maximum.
+    Output:
+        - Value at the center of each bin
+        - Number of values in each bin
+    """
+    if values.dtype.kind in "ui" and values.dtype.itemsize <= 2:
+        flat = values.reshape(-1)
+        offset = 0
+        if values.dtype.kind == "i":
+            offset = int(flat.min())
+            flat = flat.astype(np.int32) - offset
+        counts = np.bincount(flat)
+
+        width = -(-len(counts) // HISTOGRAM_BINS)
+        if width > 1:
+            counts = np.pad(counts, (0, (-len(counts)) % width)).reshape(-1, width).sum(axis=1)
+        centers = np.arange(len(counts), dtype=float) * width + (width - 1) / 2 + offset
+        return centers, counts
+
+    counts, edges = np.histogram(values, bins=HISTOGRAM_BINS)
+    return (edges[:-1] + edges[1:]) / 2, counts
+
+
+def weightedMedian(centers, counts):
+    cumulative = np.cumsum(counts)
+    return centers[np.searchsorted(cumulative, cumulative[-1] / 2)]
+
+
+def estimate(values, method="gaussian"):
+    """
+    Estimates the center and spread of the background intensities.
+    Input:
+        - values -> Pixels to estimate from, usually the output of samplePlane
+        - method:
+            - "gaussian" -> Mean and standard deviation of all values (what scipy's norm.fit returns).
+                            Bright foreground pulls both upwards.
+            - "mad" -> Median and median absolute deviation, scaled to the standard deviation of a Gaussian.
+            - "mode" -> Gaussian fitted to the histogram peak: the mode, and the half width at half maximum
+                        of the lower side of the peak, which foreground signal does not reach.
+    Output:
+        - center, spread
+    """
+    if method == "gaussian":
+        return values.mean(), values.std()
+
+    centers, counts = histogram(values)
+
+    if method == "mad":
+        median = weightedMedian(centers, counts)
+        deviations = np.abs(centers - median)
+        order = np.argsort(deviations, kind="stable")
+        mad = weightedMedian(deviations[order], counts[order])
+        return median, 1.4826 * mad
+
+    if method == "mode":
+        peak = int(np.argmax(counts))
+        below = np.flatnonzero(counts[:peak + 1] < counts[peak] / 2)
+        if len(below) == 0:
+            # The peak is at the darkest value, fall back to the upper side
+            above = np.flatnonzero(counts[peak:] < counts[peak] / 2)
+            halfWidth = centers[peak + above[0]] - centers[peak] if len(above) != 0 else 0.0
+        else:
+            halfWidth = centers[peak] - centers[below[-1]]
+        return centers[peak], halfWidth / np.sqrt(2 * np.log(2))
+
+    raise ValueError("Unknown background method: " + str(method))
+
+
+class BackgroundEstimator:
+    """
+    Estimates and caches background thresholds.
+    Inputs:
+        - method -> Estimator, see estimate
+        - stdDevs -> Number of spreads above the center that is subtracted
+        - step, size -> Subsampling, see samplePlane
+    Estimates are cached by key (e.g. scene, channel and Z-Plane), so each plane is only read and estimated once.
+    """
+
+    def __init__(self, method="gaussian", stdDevs=0, step=1, size=None):
+        if method not in METHODS:
+            raise ValueError("Unknown background method: " + str(method))
+        self.method = method
+        self.stdDevs = stdDevs
+        self.step = step
+        self.size = size
+        self.cache = {}
+
+    def estimate(self, key, readPlane):
+        """
+        Input:
+            - key -> Hashable key identifying the plane
+            - readPlane -> Function returning the 2D plane, only called if key is not cached
+        Output:
+            - center, spread, threshold
+        """
+        if key not in self.cache:
+            center, spread = estimate(samplePlane(readPlane(), self.step, self.size), self.method)
+            self.cache[key] = (center, spread, center + (spread * self.stdDevs))
+        return self.cache[key]
+
+
+def otsuThreshold(values):
+    """
+    Otsu's threshold separating foreground from background: the histogram bin that maximizes the variance
+    between the values below and above it.
+    """
+    centers, counts = histogram(np.asarray(values))
+    counts = counts.astype(np.float64)
+    below = np.cumsum(counts)
+    above = below[-1] - below
+    sumBelow = np.cumsum(counts * centers)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        meanBelow = sumBelow / below
+        meanAbove = (sumBelow[-1] - sumBelow) / above
+        between = below * above * (meanBelow - meanAbove) ** 2
+    return float(centers[np.nanargmax(between[:-1])]) if len(centers) > 1 else float(centers[0])
@@ -0,0 +1,480 @@
+import argparse
+import contextlib
+import io
+import importlib.util
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+import Background
+import OutputWriter
+import Peaks
+import ProfileKernel
+import ProfileOptions
+import RadialProfileEngine as rpe
+import ROILoader
+import ROIMasks
+
+
+VALIDATION = Path(__file__).parent / "Validation"
+
+# Reference crops saved by the plugin (PluginData) and the (Y, X) center of the profile within each crop.
+# The centers are not stored with the crops, they were recovered by matching the crops to their Radial.csv.
+REFERENCE_CROPS = {"ConcentricCircles/Test1": (494, 489),
+                   "ConcentricCircles/Test2": (319, 285),
+                   "FijiNeuron/Test1": (34, 60)}
+
+# Fiji bins radii differently and does not mask the ROI, so only the typical (median) relative difference is checked
+FIJI_TOLERANCE = 0.1
+
+# Largest absolute difference allowed between the headless pipeline and the CustomImage reference per ROI.
+# The reference masks were rasterized by Napari, which differs from ROIMasks on pixels on the ROI boundary.
+CUSTOM_IMAGE_TOLERANCE = {"ROI_0": 1.0, "ROI_1": 1.5, "ROI_2": 1e-9}
+
+# Entry points whose import is timed in a fresh interpreter, by stage name
+STARTUP_SCRIPTS = {"headless": "RunHeadlessProfile",
+                   "renderPlots": "RenderPlots",
+                   "findPeaks": "FindPeaks",
+                   "exportResults": "ExportResults",
+                   "convertROIs": "ConvertROIs",
+                   "gui": "RadialProfileWindow"}
+
+# Heavy dependencies that are only imported once the feature using them runs, never when a script starts
+DEFERRED_MODULES = ("napari", "matplotlib", "pandas", "scipy", "pyarrow", "dask", "zarr", "aicsimageio", "tifffile")
+
+# A stage is reported as a regression if it is this much slower than in the baseline
+REGRESSION_THRESHOLD = 0.25
+
+
+class Recorder:
+    """
+    Collects the time and peak memory of each stage of a benchmark case.
+    """
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.records = []
+        self.failures = []
+
+    def measure(self, case, stage, function):
+        """
+        Runs function repeat times and records the fastest time and the peak memory allocated by a single run.
+        Output: Return value of the last run
+        """
+        seconds = []
+        peak = 0
+        for _ in range(self.repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            result = function()
+            seconds.append(time.perf_counter() - start)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        self.records.append({"case": case, "stage": stage, "seconds": min(seconds), "peakMB": peak / 2**20})
+        return result
+
+    def check(self, case, description, passed):
+        print(("PASS " if passed else "FAIL ") + case + ": " + description)
+        if not passed:
+            self.failures.append(case + ": " + description)
+
+
+def readFiji(path):
+    # Fiji writes the unit (e.g. µm) of the header in latin-1
+    return np.genfromtxt(path, delimiter=",", skip_header=1, encoding="latin-1")[:, 1]
+
+
+def referenceCrops(recorder):
+    """
+    Profiles the crops saved in each PluginData folder and compares them to the Radial.csv next to them and,
+    more loosely, to the Fiji Radial Profile Plot output in FijiData.
+    """
+    for case, center in REFERENCE_CROPS.items():
+        folder = VALIDATION / case
+        crops = np.asarray([tifffile.imread(path) for path in sorted((folder / "PluginData").glob("ROI_0_Channel_*.tiff"))])
+        reference = np.loadtxt(folder / "PluginData" / "Radial.csv", delimiter=",", skiprows=1, ndmin=2)[:, 1:]
+
+        means, counts = recorder.measure(case, "profile", lambda: ProfileKernel.radialProfiles(crops, center))
+        difference = np.abs(means[:, :len(reference)].T - reference).max()
+        recorder.check(case, "matches PluginData/Radial.csv (max difference " + str(difference) + ")",
+                       means.shape[1] >= len(reference) and difference < 1e-9)
+
+        # Fiji starts at radius 1
+        for channel, fijiPath in enumerate(sorted((folder / "FijiData").glob("*Radial*.csv"))):
+            fiji = readFiji(fijiPath)
+            n = min(len(fiji), len(reference) - 1)
+            relative = np.abs(means[channel, 1:n + 1] - fiji[:n]) / np.maximum(np.abs(fiji[:n]), 1)
+            recorder.check(case, "agrees with " + fijiPath.name + " (median relative difference " +
+                           str(round(float(np.median(relative)), 4)) + ")", np.median(relative) < FIJI_TOLERANCE)
+
+
+def customImage(recorder, outputPath):
+    """
+    Runs every stage of the headless pipeline on the CustomImage validation image with the ROIs of the reference
+    run, and compares the profiles with the reference Radial.csv files and their peaks with the reference peak tables.
+    """
+    import ImageAccess
+
+    case = "CustomImage"
+    folder = VALIDATION / case
+    image = ImageAccess.openImage(folder / "Images" / "validation_image.tif", "aicsimageio")
+    reader = ImageAccess.SceneReader(image)
+    rois = ROILoader.loadTableROIs(folder, "validation_image_0")[1]
+    channels = rpe.channelNames(reader.nChannels)
+
+    masks = recorder.measure(case, "masks", lambda: [ROIMasks.localMask(roi.vertices, roi.shapeType, reader.shape)
+                                                     for roi in rois])
+    crops = recorder.measure(case, "crop", lambda: [[rpe.maskCrop(crop, mask) for crop in
+                                                     reader.crop(range(len(channels)), 0, bounds)]
+                                                    for mask, bounds in masks])
+    profiles = recorder.measure(case, "profile", lambda: [rpe.radialProfiles(roiCrops, (int(roi.center[0]), int(roi.center[1])), bounds)
+                                                          for roi, roiCrops, (mask, bounds) in zip(rois, crops, masks)])
+    recorder.measure(case, "background", lambda: [rpe.subtractThreshold(plane, Background.BackgroundEstimator().estimate(None, lambda: plane)[2])
+                                                   for plane in reader.plane(range(len(channels)), 0)])
+
+    def write():
+        for index, (roiCrops, (yRPs, counts)) in enumerate(zip(crops, profiles)):
+            roiPath = outputPath / case / Path("ROI_" + str(index))
+            rpe.checkPath(roiPath)
+            for channel, crop in zip(channels, roiCrops):
+                tifffile.imwrite(roiPath / Path("ROI_" + str(index) + "_" + channel + ".tiff"), crop)
+            xRad = np.arange(len(yRPs[0]), dtype=float)
+            rpe.writeRadial(roiPath / Path("Radial.csv"), xRad, yRPs, channels, "Pixels")
+            rpe.simplePlot(xRad, yRPs, channels, "Pixels", roiPath / Path("RadialPlot.png"))
+    recorder.measure(case, "write", write)
+
+    for index, (yRPs, counts) in enumerate(profiles):
+        roiName = "ROI_" + str(index)
+        reference = np.loadtxt(folder / roiName / "Radial.csv", delimiter=",", skiprows=1, ndmin=2)[:, 1:]
+        difference = np.abs(np.asarray(yRPs).T - reference).max() if len(reference) == len(yRPs[0]) else np.inf
+        recorder.check(case, roiName + " matches Radial.csv (max difference " + str(difference) + ")",
+                       difference <= CUSTOM_IMAGE_TOLERANCE[roiName])
+
+    xs = [np.arange(len(yRPs[0]), dtype=float) for yRPs, counts in profiles]
+    found = recorder.measure(case, "peaks", lambda: Peaks.PeakFinder().find(xs, [yRPs for yRPs, counts in profiles])[0])
+    for index, peaks in enumerate(found):
+        roiName = "ROI_" + str(index)
+        for channel, (positions, relativePositions, heights) in zip(channels, peaks):
+            reference = np.loadtxt(folder / roiName / "Peaks" / (roiName + "_" + channel + "_Peaks.csv"),
+                                   delimiter=",", skiprows=1, ndmin=2)
+            recorder.check(case, roiName + " " + channel + " peaks match the reference peak positions",
+                           np.array_equal(positions, reference[:, 0]) and np.array_equal(relativePositions, reference[:, 1]))
+
+
+def startup(recorder):
+    """
+    Times the import of every entry point in a fresh interpreter (including the interpreter's own startup)
+    and checks that none of them loads a deferred dependency before it is used.
+    """
+    case = "Startup"
+    for stage, module in STARTUP_SCRIPTS.items():
+        if module == "RadialProfileWindow" and importlib.util.find_spec("PyQt5") is None:
+            print("SKIP " + case + ": " + module + " needs PyQt5")
+            continue
+        code = ("import json, sys\nimport " + module + "\n"
+                "print(json.dumps([name for name in " + repr(DEFERRED_MODULES) + " if name in sys.modules]))")
+        result = recorder.measure(case, stage, lambda: subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent,
+                                                                      capture_output=True, text=True))
+        loaded = json.loads(result.stdout) if result.returncode == 0 else [result.stderr.strip().splitlines()[-1]]
+        recorder.check(case, module + " starts without loading deferred dependencies" +
+                       ("" if len(loaded) == 0 else " (loaded " + ", ".join(loaded) + ")"), len(loaded) == 0)
+
+
+def invalidROIs(recorder, outputPath):
+    """
+    Profiles a scene in which an ROI that cannot be rasterized (an ellipse with too few vertices) lies between two
+    valid ROIs. Only the invalid ROI may be skipped.
+    """
+    import ImageAccess
+
+    case = "InvalidROI"
+    imagePath = outputPath / case / "image.tif"
+    rpe.checkPath(imagePath.parent)
+    tifffile.imwrite(imagePath, syntheticImage(128, 2), imagej=True, metadata={"axes": "CYX"})
+    image = ImageAccess.openImage(imagePath)
+    channels = rpe.channelNames(image.dims.C)
+
+    square = np.array([[30.0, 30.0], [30.0, 60.0], [60.0, 60.0], [60.0, 30.0]])
+    rois = [ROILoader.ROI(square, "ellipse", (45, 45)),
+            ROILoader.ROI(square[:2], "ellipse", (45, 45)),
+            ROILoader.ROI(square + 50, "rectangle", (95, 95))]
+    profiler = rpe.HeadlessProfiler(image, ["image"], {"image": image.scenes[0]}, channels, channels, 1.0, "Pixels",
+                                    outputOptions=ProfileOptions.OutputOptions(plots=False, incremental=False))
+    scenePath = outputPath / case / "image_0"
+    rpe.checkPath(scenePath)
+    with contextlib.redirect_stdout(io.StringIO()):
+        profiler.profileScene(rois, scenePath, "image_0")
+    profiler.closeWriter()
+
+    profiled = [(scenePath / ("ROI_" + str(index)) / "Radial.csv").exists() for index in range(len(rois))]
+    recorder.check(case, "only the invalid ROI is skipped (profiled " + str(profiled) + ")", profiled == [True, False, True])
+
+
+def autoROIs(recorder, size):
+    """
+    Segments a synthetic plane into ROIs centered on the brightest pixel of each region, and checks that every
+    center lies within its ROI's crop, so no generated ROI is skipped.
+    """
+    import AutoROIs
+
+    case = "AutoROIs_" + str(size) + "px"
+    plane = syntheticImage(size, 1)[0]
+    labels = AutoROIs.thresholdLabels(plane)
+    props = recorder.measure(case, "regionProps", lambda: AutoROIs.regionProps(labels, plane))
+    rois = AutoROIs.propsToROIs(props, "max")
+
+    outside = 0
+    for roi in rois:
+        ymin, ymax, xmin, xmax = ROIMasks.cropBounds(roi.vertices, size, size)
+        centerY, centerX = int(roi.center[0]) - ymin, int(roi.center[1]) - xmin
+        outside += not (0 <= centerY < ymax - ymin and 0 <= centerX < xmax - xmin)
+    recorder.check(case, "every max center of " + str(len(rois)) + " ROIs lies within its crop (" + str(outside) +
+                   " outside)", outside == 0)
+
+
+def chunkReads(reader, function):
+    """
+    Runs function and counts the chunks of reader's image that were decoded, by counting the aicsimageio read tasks
+    dask executed.
+    Output: Number of chunks read and number of pixels in each chunk
+    """
+    from dask.callbacks import Callback
+
+    class ChunkCounter(Callback):
+        def __init__(self):
+            super(ChunkCounter, self).__init__()
+            self.reads = 0
+
+        def _pretask(self, key, dask, state):
+            # Read tasks are fused with the slicing that follows them, the read stays part of the task name
+            if "get_image_data" in str(key[0] if isinstance(key, tuple) else key):
+                self.reads += 1
+
+    with ChunkCounter() as counter:
+        function()
+    return counter.reads, int(np.prod(reader.data.chunksize))
+
+
+def zStack(recorder, outputPath, size, nZ):
+    """
+    Reads crops from a multi Z-Plane TIFF opened with aicsimageio, and checks that each crop only decodes the planes
+    of its own Z-Plane and channels. The streamed maximum projection of the stack is timed against dask's own
+    reduction of the same file, and must decode every plane exactly once.
+    """
+    import ImageAccess
+
+    case = "ZStack_" + str(size) + "px_" + str(nZ) + "z"
+    imagePath = outputPath / (case + ".tif")
+    planes = np.stack([syntheticImage(size, 2, seed=z) for z in range(nZ)])
+    tifffile.imwrite(imagePath, planes, imagej=True, metadata={"axes": "ZCYX"})
+    reader = ImageAccess.SceneReader(ImageAccess.openImage(imagePath, "aicsimageio"))
+
+    bounds = (size // 2, size // 2 + 10, size // 2, size // 2 + 10)
+    crop = recorder.measure(case, "crop", lambda: reader.crop([0, 1], nZ // 2, bounds))
+    reads, chunkPixels = chunkReads(reader, lambda: reader.crop([0, 1], nZ // 2, bounds))
+    ymin, ymax, xmin, xmax = bounds
+    recorder.check(case, "crop matches the written planes", np.array_equal(crop, planes[nZ // 2, :, ymin:ymax, xmin:xmax]))
+    recorder.check(case, "a 10x10 crop of 2 channels decodes " + str(reads * chunkPixels) + " pixels (at most 2 planes)",
+                   reads * chunkPixels <= 2 * size * size)
+
+    # Maximum projection of both channels streamed one plane at a time, compared with dask's own reduction
+    image = reader.image
+    expected = planes.max(axis=0)
+    projector = ImageAccess.SceneReader(image, maxIntensity=True)
+    projected = recorder.measure(case, "project", lambda: projector.plane([0, 1], None))
+    reads, chunkPixels = chunkReads(projector, lambda: projector.plane([0, 1], None))
+    recorder.check(case, "project matches the projection and decodes every plane once (" +
+                   str(reads * chunkPixels // (size * size)) + " planes)",
+                   np.array_equal(projected, expected) and reads * chunkPixels == 2 * nZ * size * size)
+    # dask hides its callbacks from computes started while another one runs, so reads are only counted on one thread
+    projector = ImageAccess.SceneReader(image, maxIntensity=True, threads=4)
+    projected = recorder.measure(case, "projectThreads", lambda: projector.plane([0, 1], None))
+    recorder.check(case, "projectThreads matches the projection", np.array_equal(projected, expected))
+    projected = recorder.measure(case, "projectDask", lambda: np.asarray(reader.data[0, [0, 1]].max(axis=1)))
+    recorder.check(case, "projectDask matches the projection", np.array_equal(projected, expected))
+
+
+def syntheticImage(size, nChannels, seed=0):
+    """
+    Noisy uint16 background with bright blobs, shape (C, size, size)
+    """
+    rng = np.random.default_rng(seed)
+    image = rng.normal(500, 50, (nChannels, size, size))
+    y, x = np.ogrid[-30:31, -30:31]
+    blob = 2000 * np.exp(-(y ** 2 + x ** 2) / 200.0)
+    for blobY, blobX in rng.integers(30, size - 30, (size // 16, 2)):
+        image[:, blobY - 30:blobY + 31, blobX - 30:blobX + 31] += blob
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def syntheticROIs(size, nROIs, seed=0):
+    """
+    Polygons, ellipses and rectangles of 10 to 50 pixel radius spread over the image
+    """
+    rng = np.random.default_rng(seed)
+    rois = []
+    for index in range(nROIs):
+        centerY, centerX = rng.uniform(50, size - 50, 2)
+        radius = rng.uniform(10, 50)
+        shapeType = ("polygon", "ellipse", "rectangle")[index % 3]
+        if shapeType == "polygon":
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 12))
+            radii = radius * rng.uniform(0.6, 1.0, 12)
+            vertices = np.column_stack([centerY + radii * np.sin(angles), centerX + radii * np.cos(angles)])
+        else:
+            vertices = np.array([[centerY - radius, centerX - radius], [centerY - radius, centerX + radius],
+                                 [centerY + radius, centerX + radius], [centerY + radius, centerX - radius]])
+        rois.append(ROILoader.ROI(vertices, shapeType, (centerY, centerX)))
+    return rois
+
+
+def synthetic(recorder, outputPath, size, nROIs, nChannels):
+    """
+    Times every stage on an in-memory synthetic image.
+    """
+    case = "Synthetic_" + str(size) + "px_" + str(nROIs) + "rois_" + str(nChannels) + "ch"
+    image = syntheticImage(size, nChannels)
+    rois = syntheticROIs(size, nROIs)
+    shape = image.shape[1:]
+
+    masks = recorder.measure(case, "masks", lambda: [ROIMasks.localMask(roi.vertices, roi.shapeType, shape)
+                                                     for roi in rois])
+    thresholds = recorder.measure(case, "background", lambda: [Background.BackgroundEstimator(stdDevs=1).estimate(None, lambda: plane)[2]
+                                                               for plane in image])
+    def crop(mask, bounds):
+        ymin, ymax, xmin, xmax = bounds
+        return [rpe.maskCrop(rpe.subtractThreshold(plane[ymin:ymax, xmin:xmax], threshold), mask)
+                for plane, threshold in zip(image, thresholds)]
+
+    crops = recorder.measure(case, "crop", lambda: [crop(mask, bounds) for mask, bounds in masks])
+    def profile(cold):
+        if cold:
+            ProfileKernel.indexCache.clear()
+        return [rpe.radialProfiles(roiCrops, (int(roi.center[0]), int(roi.center[1])), bounds)
+                for roi, roiCrops, (mask, bounds) in zip(rois, crops, masks)]
+
+    profiles = recorder.measure(case, "profile", lambda: profile(True))
+    # Every radius index map already cached, as for ROIs of a repeated geometry
+    recorder.measure(case, "profileCached", lambda: profile(False))
+
+    # Profiles of 8 angular sectors, whose marginal is the isotropic profile
+    sectors = recorder.measure(case, "profileSectors", lambda: [rpe.sectorProfiles(roiCrops, (int(roi.center[0]), int(roi.center[1])), bounds, 8)
+                                                                for roi, roiCrops, (mask, bounds) in zip(rois, crops, masks)])
+    difference = max(float(np.max(np.abs(np.asarray(sector[0]) - np.asarray(isotropic[0])))) for sector, isotropic in zip(sectors, profiles))
+    recorder.check(case, "sector marginals match the isotropic profiles (max difference " + str(difference) + ")",
+                   difference < 1e-9)
+
+    channels = rpe.channelNames(nChannels)
+
+    def write():
+        for index, (yRPs, counts) in enumerate(profiles):
+            roiPath = outputPath / case / Path("ROI_" + str(index))
+            rpe.checkPath(roiPath)
+            rpe.writeRadial(roiPath / Path("Radial.csv"), np.arange(len(yRPs[0]), dtype=float), yRPs, channels, "Pixels")
+    recorder.measure(case, "write", write)
+
+    # The same files written by the threads of an OutputWriter, as during a run
+    def writeAsync():
+        writer = OutputWriter.OutputWriter()
+        for index, (yRPs, counts) in enumerate(profiles):
+            roiPath = outputPath / case / Path("ROI_" + str(index))
+            writer.submit(index, "writeCSV", rpe.writeRadial, roiPath / Path("Radial.csv"),
+                          np.arange(len(yRPs[0]), dtype=float), yRPs, channels, "Pixels")
+        writer.close()
+    recorder.measure(case, "writeAsync", writeAsync)
+
+
+def zStackCase(quick):
+    """
+    (image size, Z-Plane count) of the multi Z-Plane case
+    """
+    return (512, 8) if quick else (2048, 32)
+
+
+def scalingCases(quick):
+    """
+    (image size, ROI count, channel count) of each synthetic case, varying one at a time
+    """
+    if quick:
+        return [(512, 20, 2)]
+    cases = [(size, 100, 2) for size in (512, 2048, 4096)]
+    cases += [(2048, nROIs, 2) for nROIs in (10, 1000)]
+    cases += [(2048, 100, nChannels) for nChannels in (1, 8)]
+    return cases
+
+
+def compareBaseline(records, baselinePath, threshold):
+    """
+    Stages that got more than threshold slower than in the baseline JSON written by --output.
+    """
+    with open(baselinePath) as f:
+        baseline = {(record["case"], record["stage"]): record for record in json.load(f)["records"]}
+
+    regressions = []
+    for record in records:
+        previous = baseline.get((record["case"], record["stage"]))
+        if previous is not None and record["seconds"] > previous["seconds"] * (1 + threshold):
+            regressions.append(record["case"] + " " + record["stage"] + ": " + "{:.4f}s -> {:.4f}s".format(previous["seconds"], record["seconds"]))
+    return regressions
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Check the radial profiles against the Validation references and time each stage of the analysis.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each stage, the fastest is reported")
+    parser.add_argument("--quick", action="store_true", help="Only run a single small synthetic case")
+    parser.add_argument("--no-validation", action="store_true", help="Skip the Validation reference checks")
+    parser.add_argument("--output", default=None, help="Write the timings to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Timings JSON of a previous run to check for regressions")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Relative slowdown reported as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    recorder = Recorder(args.repeat)
+
+    startup(recorder)
+    with tempfile.TemporaryDirectory() as tempPath:
+        outputPath = Path(tempPath)
+        if not args.no_validation:
+            referenceCrops(recorder)
+            customImage(recorder, outputPath)
+        invalidROIs(recorder, outputPath)
+        autoROIs(recorder, zStackCase(args.quick)[0])
+        zStack(recorder, outputPath, *zStackCase(args.quick))
+        for size, nROIs, nChannels in scalingCases(args.quick):
+            synthetic(recorder, outputPath, size, nROIs, nChannels)
+
+    print()
+    print("{:<36}{:<16}{:>12}{:>12}".format("Case", "Stage", "Seconds", "Peak MB"))
+    for record in recorder.records:
+        print("{:<36}{:<16}{:>12.4f}{:>12.1f}".format(record["case"], record["stage"], record["seconds"], record["peakMB"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"repeat": args.repeat, "records": recorder.records}, f, indent=1)
+
+    regressions = []
+    if args.baseline is not None:
+        regressions = compareBaseline(recorder.records, args.baseline, args.threshold)
+        print()
+        for regression in regressions:
+            print("REGRESSION " + regression)
+
+    if len(recorder.failures) != 0 or len(regressions) != 0:
+        print()
+        print(str(len(recorder.failures)) + " failed checks, " + str(len(regressions)) + " regressions")
+        return 1
+    return 0
+
+
+if __name__=="__main__":
+    sys.exit(main())
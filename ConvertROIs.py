@@ -0,0 +1,24 @@
+import argparse
+from pathlib import Path
+
+import ROILoader
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Build the binary ROI index (sceneName_ROIs.npz) of every scene of a run written before indexes existed, from its _Table.csv and ROI_n_Coordinates.csv files.")
+    parser.add_argument("output", help="Output directory of a run")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    for scenePath in sorted(path for path in Path(args.output).iterdir() if path.is_dir()):
+        if not (scenePath / Path(scenePath.name + "_Table.csv")).exists():
+            continue
+        try:
+            names, rois = ROILoader.convertScene(scenePath, scenePath.name)
+            print(scenePath.name + ": " + str(len(rois)) + " ROIs")
+        except Exception as e:
+            print("ROIs of", scenePath.name, "could not be converted")
+            print(e)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,17 @@
+import argparse
+
+import ResultsStore
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Export the Profiles.parquet and ROIs.parquet files of a run to the usual folder per scene and ROI layout.")
+    parser.add_argument("store", help="Output directory of a run with --output-format parquet")
+    parser.add_argument("output", nargs="?", default=None, help="Directory the folders are written to (default: the store directory)")
+    parser.add_argument("--no-plots", action="store_true", help="Do not draw RadialPlot.png for every ROI")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    ResultsStore.exportTree(args.store, args.output, plots=not args.no_plots)
+
+if __name__=="__main__":
+    main()
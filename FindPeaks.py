@@ -0,0 +1,23 @@
+import argparse
+
+import Peaks
+
+def addPeakArgs(parser):
+    parser.add_argument("--prominence", type=float, default=10, help="Minimum prominence of a peak")
+    parser.add_argument("--width", type=float, default=None, help="Minimum width of a peak in radius bins, at half its prominence")
+    parser.add_argument("--smoothing", type=int, default=1, help="Width of the moving average applied to the profiles before peaks are searched")
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Find the peaks of every profile of a finished run from its Radial.csv files or Profiles.parquet.")
+    parser.add_argument("output", help="Output directory of a run")
+    addPeakArgs(parser)
+    parser.add_argument("--no-plots", action="store_true", help="Do not draw Channel_m_Peaks.png for every ROI")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    finder = Peaks.PeakFinder(args.prominence, args.width, args.smoothing)
+    Peaks.findRunPeaks(args.output, finder, plots=not args.no_plots)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,225 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+
+PROJECTIONS = ("max", "mean", "sum")
+BACKENDS = ("auto", "aicsimageio", "tifffile")
+TIFF_SUFFIXES = (".tif", ".tiff", ".btf", ".tf8")
+
+# Dimensions of each dask chunk of images opened with aicsimageio, one chunk per Y, X plane
+CHUNK_DIMS = ["Y", "X"]
+
+# Largest plane the viewer is given at its coarsest pyramid level
+PYRAMID_SIZE = 2048
+
+
+def openImage(path, backend="auto"):
+    """
+    Opens an image with aicsimageio, or with TiledImage for slide-scale TIFFs that do not fit in memory.
+    Input:
+        - path -> Path of the image
+        - backend -> "aicsimageio", "tifffile" (TiledImage) or "auto", which uses TiledImage for tiled or
+                     pyramidal TIFFs and aicsimageio for everything else
+    Output:
+        - An AICSImage or TiledImage
+    """
+    if backend not in BACKENDS:
+        raise ValueError("Unknown image backend: " + str(backend))
+    path = Path(path)
+    if backend == "auto":
+        import TiledImage
+        backend = "tifffile" if path.suffix.lower() in TIFF_SUFFIXES and TiledImage.isTiled(path) else "aicsimageio"
+
+    if backend == "tifffile":
+        import TiledImage
+        return TiledImage.TiledImage(path)
+    from aicsimageio import AICSImage
+    # aicsimageio chunks each channel across all Z-Planes by default, so reading a crop would decode every
+    # Z-Plane of the channel. With one chunk per plane a crop decodes at most one plane per channel.
+    return AICSImage(path, chunk_dims=CHUNK_DIMS)
+
+
+def closeImage(image):
+    """
+    Closes the file of an image opened by openImage. AICSImage keeps no file open, so only TiledImage is closed.
+    """
+    close = getattr(image, "close", None)
+    if close is not None:
+        close()
+
+
+def accumulatorType(dtype, projection):
+    """
+    dtype the running projection is kept in: max keeps the image dtype, sums are widened so they cannot overflow.
+    """
+    dtype = np.dtype(dtype)
+    if projection == "max":
+        return dtype
+    if projection == "sum" and np.issubdtype(dtype, np.unsignedinteger):
+        return np.dtype(np.uint64)
+    if projection == "sum" and np.issubdtype(dtype, np.integer):
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+def projectStack(stack, projection="max", zRange=None, threads=1):
+    """
+    Projects a (Z, Y, X) stack across Z one plane at a time, so only a single plane and one running projection
+    per thread are held in memory in addition to the output.
+    Every plane is read exactly once and whole, so a plane chunked image (see openImage) decodes each chunk once.
+    Input:
+        - stack -> (Z, Y, X) array like (numpy, dask, memory mapped, ...). Planes are read with stack[z]
+        - projection -> "max", "mean" or "sum"
+        - zRange -> Optional (start, stop) range of Z-Planes to project
+        - threads -> Number of threads, each projecting its own group of Z-Planes
+    Output:
+        - (Y, X) projection. Maximum projections keep the dtype of the stack, mean projections are float64
+          and sums are widened to 64 bits.
+    """
+    if projection not in PROJECTIONS:
+        raise ValueError("Unknown projection: " + str(projection))
+
+    zStart, zStop = (0, stack.shape[0]) if zRange is None else zRange
+    if zStop <= zStart:
+        raise ValueError("Empty Z range: " + str((zStart, zStop)))
+
+    accType = accumulatorType(stack.dtype, projection)
+
+    def combine(acc, plane):
+        if projection == "max":
+            np.maximum(acc, plane, out=acc)
+        else:
+            acc += plane
+
+    def reduceGroup(zPlanes):
+        acc = np.array(stack[zPlanes[0]], dtype=accType)
+        for z in zPlanes[1:]:
+            combine(acc, np.asarray(stack[z]))
+        return acc
+
+    groups = [group for group in np.array_split(np.arange(zStart, zStop), max(1, threads)) if len(group) != 0]
+    if len(groups) == 1:
+        out = reduceGroup(groups[0])
+    else:
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            partial = list(pool.map(reduceGroup, groups))
+        out = partial[0]
+        for acc in partial[1:]:
+            combine(out, acc)
+
+    if projection == "mean":
+        return out / (zStop - zStart)
+    return out
+
+
+class SceneReader:
+    """
+    Lazy access to the current scene of an AICSImage.
+    Pixels are only read from disk when a plane or crop is requested, and only for the channels and
+    Z-Plane in use, so a scene never has to fit in memory. Images are read in their dask chunks, which for
+    images opened by openImage hold a single plane (or tile, see TiledImage), so a crop decodes at most one
+    plane per channel. The reader keeps reading the scene that was current when it was created, even if
+    the scene of the image is changed afterwards.
+    Inputs:
+        - image -> A AICSImage instance from the aicsimageio package, set to the scene to be read
+        - maxIntensity -> If True, every plane and crop is a projection across Z instead of a single Z-Plane
+        - projection -> Projection used when maxIntensity is set: "max", "mean" or "sum"
+        - zRange -> Optional (start, stop) range of Z-Planes included in the projection
+        - threads -> Number of threads used when projecting full planes
+    """
+
+    def __init__(self, image, maxIntensity=False, projection="max", zRange=None, threads=1):
+        self.image = image
+        self.maxIntensity = maxIntensity
+        self.projection = projection
+        self.zRange = zRange
+        self.threads = threads
+        # TCZYX dask array, nothing is read until it is computed
+        self.data = image.dask_data
+        # Resolution levels stored in the file (TiledImage only)
+        self.levels = getattr(image, "dask_levels", [self.data])
+
+    @property
+    def nChannels(self):
+        return self.data.shape[1]
+
+    @property
+    def shape(self):
+        """
+        (Y, X) shape of the scene
+        """
+        return tuple(self.data.shape[-2:])
+
+    @property
+    def nZ(self):
+        return self.data.shape[2]
+
+    @property
+    def nT(self):
+        return self.data.shape[0]
+
+    def pyramid(self, maxSize=PYRAMID_SIZE):
+        """
+        TCZYX resolution levels for the viewer, full resolution first. Levels stored in the file are used, and
+        levels of half the size are added (by taking every second row and column) until a plane fits in maxSize.
+        """
+        levels = list(self.levels)
+        while max(levels[-1].shape[-2:]) > maxSize:
+            levels.append(levels[-1][..., ::2, ::2])
+        return levels
+
+    def planeReader(self):
+        """
+        Reader of the same scene that reads single Z-Planes instead of projections.
+        """
+        reader = copy.copy(self)
+        reader.maxIntensity = False
+        return reader
+
+    def read(self, channels, z, t=0, bounds=None):
+        """
+        Reads a (C, Y, X) array of the given channel indices at Z-Plane z (ignored for projections).
+        If bounds (ymin, ymax, xmin, xmax) are given, only that region is read.
+        """
+        data = self.data[t][list(channels)]
+        if bounds is not None:
+            ymin, ymax, xmin, xmax = bounds
+            data = data[..., ymin:ymax, xmin:xmax]
+
+        if not self.maxIntensity:
+            return np.asarray(data[:, 0 if z is None else z])
+
+        if self.zRange is not None:
+            data = data[:, self.zRange[0]:self.zRange[1]]
+        # A bounding box across Z is small enough to read at once, full planes are streamed one Z-Plane at a time
+        if bounds is not None:
+            data = np.asarray(data)
+            return np.stack([projectStack(stack, self.projection) for stack in data])
+        return np.stack([projectStack(stack, self.projection, threads=self.threads) for stack in data])
+
+    def plane(self, channels, z, t=0):
+        """
+        Reads full (C, Y, X) planes of the given channel indices.
+        """
+        return self.read(channels, z, t)
+
+    def crop(self, channels, z, bounds, t=0):
+        """
+        Reads only the bounding box (ymin, ymax, xmin, xmax) of the given channel indices.
+        Output: (C, ymax - ymin, xmax - xmin) array
+        """
+        return self.read(channels, z, t, bounds)
+
+    def stack(self, channels, bounds, zRange=None):
+        """
+        Reads the bounding box (ymin, ymax, xmin, xmax) of the given channel indices at every timepoint and
+        Z-Plane (or only Z-Planes start to stop - 1 of zRange), regardless of the projection.
+        Output: (T, Z, C, ymax - ymin, xmax - xmin) array
+        """
+        ymin, ymax, xmin, xmax = bounds
+        zStart, zStop = (0, self.nZ) if zRange is None else zRange
+        data = self.data[:, list(channels), zStart:zStop, ymin:ymax, xmin:xmax]
+        return np.asarray(data).transpose(0, 2, 1, 3, 4)
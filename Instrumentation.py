@@ -0,0 +1,161 @@
+import cProfile
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def peakRSS():
+    """
+    Peak resident memory of this process in MB, None if it cannot be read on this platform.
+    On Linux this is the high-water mark since the last resetPeakRSS, elsewhere since the process started.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def resetPeakRSS():
+    """
+    Resets the peak resident memory of this process to its current resident memory (Linux only).
+    Output: True if the peak was reset, False if peakRSS keeps reporting the peak since the process started
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class StageTimer:
+    """
+    Context manager adding the time (and, if traced, the peak memory allocated on top of what was already
+    allocated when the stage started) of one run of a stage to Timings.
+    """
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        if self.timings.traceMemory:
+            tracemalloc.reset_peak()
+            self.allocated = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stage = self.timings.stages.setdefault(self.name, {"seconds": 0.0, "calls": 0})
+        stage["seconds"] += seconds
+        stage["calls"] += 1
+        if self.timings.traceMemory:
+            peak = (tracemalloc.get_traced_memory()[1] - self.allocated) / 2**20
+            stage["peakAllocatedMB"] = max(stage.get("peakAllocatedMB", 0.0), peak)
+        return False
+
+
+class Timings:
+    """
+    Stage timers and counters of one scene.
+    Inputs:
+        - scene -> Scene name
+        - enabled -> If False, stage and count do nothing
+        - traceMemory -> Also record the peak memory allocated within each stage with tracemalloc (slower)
+    Stages must not be nested when memory is traced, each stage resets the tracemalloc peak.
+    The peak resident memory of the process is reset when enabled Timings are created, so peakRSSMB is the peak since
+    the scene (or worker chunk) started. Scenes of a parallel run are all started before the first one is finished,
+    so their peaks overlap. Where the peak cannot be reset, the peak since the process started is written as
+    processPeakRSSMB instead.
+    """
+
+    def __init__(self, scene=None, enabled=False, traceMemory=False):
+        self.scene = scene
+        self.enabled = enabled
+        self.traceMemory = enabled and traceMemory
+        self.stages = {}
+        self.counters = {}
+        self.workerPeakRSS = {}
+        self.peakKey = "peakRSSMB" if enabled and resetPeakRSS() else "processPeakRSSMB"
+        self.start = time.perf_counter()
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return StageTimer(self, name)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        Stages and counters recorded so far, as stored in _Timings.json
+        """
+        return {"stages": self.stages, "counters": self.counters, self.peakKey: peakRSS()}
+
+    def merge(self, summary):
+        """
+        Adds the stages and counters recorded by another process (see summary).
+        """
+        for name, stage in summary["stages"].items():
+            total = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            total["seconds"] += stage["seconds"]
+            total["calls"] += stage["calls"]
+            if "peakAllocatedMB" in stage:
+                total["peakAllocatedMB"] = max(total.get("peakAllocatedMB", 0.0), stage["peakAllocatedMB"])
+        for name, value in summary["counters"].items():
+            self.count(name, value)
+        for key in ("peakRSSMB", "processPeakRSSMB"):
+            if summary.get(key) is not None:
+                self.workerPeakRSS[key] = max(self.workerPeakRSS.get(key, 0.0), summary[key])
+
+    def write(self, path, workers=1):
+        """
+        Writes <scene>_Timings.json. Stage seconds are summed over all processes, wallSeconds is the time
+        since the scene was started.
+        """
+        output = {"scene": self.scene,
+                  "wallSeconds": time.perf_counter() - self.start,
+                  "workers": workers}
+        output.update(self.summary())
+        for key, peak in self.workerPeakRSS.items():
+            output["worker" + key[0].upper() + key[1:]] = peak
+        with open(path, "w") as f:
+            json.dump(output, f, indent=1)
+
+
+def startProfile(enabled):
+    """
+    cProfile profiler of a scene, None if profiling is not enabled.
+    """
+    if not enabled:
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def stopProfile(profile, path):
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(path)
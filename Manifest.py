@@ -0,0 +1,84 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+MANIFEST_VERSION = 1
+
+
+def manifestPath(scenePath, sceneName):
+    return Path(scenePath) / Path(sceneName + "_Manifest.json")
+
+
+def settingsHash(settings):
+    """
+    Hash of the analysis settings shared by every ROI of a scene (channels, pixel size, projection, background, ...).
+    Input: JSON serializable settings
+    """
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def imageIdentity(path):
+    """
+    Identifies the image file a run read: its absolute path, size and modification time, so results are not reused
+    for a different or rewritten file with the same scene names and shape.
+    Output: JSON serializable identity, None if the path is unknown or cannot be read
+    """
+    if path is None:
+        return None
+    try:
+        stat = Path(path).stat()
+    except OSError:
+        return str(path)
+    return [str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+def roiHash(roi, settings):
+    """
+    Hash of everything an ROI's output depends on: its geometry, center and Z-Plane together with the
+    settings hash of the scene.
+    """
+    digest = hashlib.sha1(settings.encode())
+    digest.update(np.ascontiguousarray(roi.vertices, dtype=np.float64).tobytes())
+    digest.update(json.dumps([roi.shapeType, roi.center, roi.z]).encode())
+    return digest.hexdigest()
+
+
+def loadManifest(scenePath, sceneName):
+    """
+    Manifest of the previous run of a scene, or an empty manifest if there is none (or it cannot be read).
+    Manifest layout:
+        - settings -> settingsHash of the run
+        - rois -> Maps ROI names to their roiHash and _Table.csv row
+        - backgrounds -> [z, channelIndex, mean, std, threshold] of every background estimate
+    """
+    try:
+        with open(manifestPath(scenePath, sceneName)) as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError):
+        pass
+    return {"version": MANIFEST_VERSION, "settings": None, "rois": {}, "backgrounds": []}
+
+
+def writeManifest(scenePath, sceneName, settings, rois, backgrounds):
+    manifest = {"version": MANIFEST_VERSION, "settings": settings, "rois": rois, "backgrounds": backgrounds}
+    with open(manifestPath(scenePath, sceneName), "w") as f:
+        json.dump(manifest, f, default=lambda value: value.item() if isinstance(value, np.generic) else str(value))
+
+
+def tableRow(row):
+    """
+    JSON friendly copy of a table row (roiName, relativeCenter, absoluteCenter, shape, z) and back.
+    """
+    roiName, relativeCenter, absoluteCenter, shape, z = row
+    return [roiName, [int(value) for value in relativeCenter], [int(value) for value in absoluteCenter], shape,
+            None if z is None else int(z)]
+
+
+def rowFromJSON(row):
+    roiName, relativeCenter, absoluteCenter, shape, z = row
+    return (roiName, tuple(relativeCenter), tuple(absoluteCenter), shape, z)
@@ -0,0 +1,80 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class OutputWriter:
+    """
+    Writes output files on a pool of threads, so ROIs are profiled while the files of earlier ROIs are still
+    being written (e.g. to a network filesystem).
+    Writes are queued with submit and waited for with flush. At most maxPending writes are queued at once,
+    submit blocks once the queue is full so the crops and profiles waiting to be written stay bounded.
+    Inputs:
+        - threads -> Number of writer threads, 0 writes synchronously in the calling thread
+        - maxPending -> Number of queued writes after which submit waits for a write to finish
+    """
+
+    def __init__(self, threads=2, maxPending=32):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="OutputWriter") if threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max(1, maxPending))
+        self.lock = threading.Lock()
+        self.futures = []
+        self.errors = {}
+        self.stages = {}
+
+    def run(self, key, stage, function, args):
+        start = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            with self.lock:
+                self.errors.setdefault(key, str(e))
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                total = self.stages.setdefault(stage, {"seconds": 0.0, "calls": 0})
+                total["seconds"] += seconds
+                total["calls"] += 1
+            if self.pool is not None:
+                self.slots.release()
+
+    def submit(self, key, stage, function, *args):
+        """
+        Queues function(*args).
+        Input:
+            - key -> Identifies the output (e.g. the ROI index) in the errors returned by flush
+            - stage -> Name of the stage the time of the write is added to, see summary
+        """
+        if self.pool is None:
+            self.run(key, stage, function, args)
+            return
+        self.slots.acquire()
+        self.futures.append(self.pool.submit(self.run, key, stage, function, args))
+
+    def flush(self):
+        """
+        Waits until every queued write is done.
+        Output:
+            - Dictionary mapping the keys of the writes that failed since the last flush to the first error message
+        """
+        wait(self.futures)
+        self.futures = []
+        with self.lock:
+            errors, self.errors = self.errors, {}
+        return errors
+
+    def summary(self):
+        """
+        Seconds and number of calls of every write stage since the last summary, in the layout of
+        Instrumentation.Timings.summary so it can be merged into the timings of a scene.
+        Stage seconds are summed over the writer threads.
+        """
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return {"stages": stages, "counters": {}, "peakRSSMB": None}
+
+    def close(self):
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
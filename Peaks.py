@@ -0,0 +1,189 @@
+from pathlib import Path
+
+import numpy as np
+
+import Plotting
+
+
+class PeakFinder:
+    """
+    Finds the peaks of the radial profiles of every channel of many ROIs at once.
+    The first (reference) channel is searched over its whole profile. Its boundary is the first radius after its
+    maximum at which it falls to zero, and the other channels are only searched from that boundary outwards
+    (over their whole profile if the reference never reaches zero).
+    Peak positions are reported both as distances and relative to the reference boundary.
+    Inputs:
+        - prominence -> Minimum prominence of a peak (see scipy.signal.find_peaks)
+        - width -> Optional minimum width of a peak in radius bins, measured at half its prominence
+        - smoothing -> Width of the moving average applied to the profiles before peaks are searched (1 is none).
+                       Peak heights are always taken from the unsmoothed profiles.
+    """
+
+    def __init__(self, prominence=10, width=None, smoothing=1):
+        self.prominence = prominence
+        self.width = width
+        self.smoothing = smoothing
+
+    def padded(self, profiles):
+        """
+        Stacks profiles of different lengths into a (N, maxLength) array, padded with their last value.
+        """
+        lengths = np.array([len(profile) for profile in profiles])
+        columns = np.minimum(np.arange(lengths.max()), (lengths - 1)[:, None])
+        concatenated = np.concatenate([np.asarray(profile, dtype=np.float64) for profile in profiles])
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        return concatenated[starts[:, None] + columns], lengths
+
+    def boundaries(self, reference, lengths):
+        """
+        Index of the first radius after the maximum of each reference profile at which it is zero
+        (0 if it never reaches zero).
+        """
+        index = np.arange(reference.shape[1])
+        after = (index > np.argmax(reference, axis=1)[:, None]) & (reference <= 0) & (index < lengths[:, None])
+        return np.where(after.any(axis=1), np.argmax(after, axis=1), 0)
+
+    def search(self, values, lengths, starts):
+        """
+        Peaks of every row of values between starts and lengths, found by a single find_peaks call over all rows.
+        Rows are laid end to end with a NaN between them, which stops the prominence and width of a peak
+        at the edges of its own row.
+        Output: List of peak index arrays, one per row
+        """
+        from scipy import signal
+
+        index = np.arange(values.shape[1])
+        walled = np.where((index >= starts[:, None]) & (index < lengths[:, None]), values, np.nan)
+        walled = np.concatenate([walled, np.full((len(walled), 1), np.nan)], axis=1)
+
+        peaks, properties = signal.find_peaks(walled.ravel(), prominence=self.prominence, width=self.width)
+        rows, columns = np.divmod(peaks, walled.shape[1])
+        return np.split(columns, np.searchsorted(rows, np.arange(1, len(values))))
+
+    def find(self, xs, profiles):
+        """
+        Input:
+            - xs -> Distance of each radius bin, one array per ROI
+            - profiles -> Profiles of each ROI, one array per channel with the reference channel first
+        Output: For each ROI, a list with one (positions, relativePositions, heights) tuple per channel
+        """
+        from scipy import ndimage
+
+        nChannels = len(profiles[0])
+        distances, lengths = self.padded(xs)
+        channels = [self.padded([profile[channel] for profile in profiles])[0] for channel in range(nChannels)]
+
+        boundaries = self.boundaries(channels[0], lengths)
+        # Distance of the boundary, NaN if the reference profile never reaches zero
+        boundaryX = np.where(boundaries > 0, distances[np.arange(len(lengths)), boundaries], np.nan)
+
+        found = [[] for _ in profiles]
+        for channel, values in enumerate(channels):
+            smoothed = values if self.smoothing <= 1 else ndimage.uniform_filter1d(values, self.smoothing, axis=1, mode="nearest")
+            starts = np.zeros_like(lengths) if channel == 0 else boundaries
+            for roi, peaks in enumerate(self.search(smoothed, lengths, starts)):
+                positions = distances[roi, peaks]
+                found[roi].append((positions, positions - boundaryX[roi], values[roi, peaks]))
+        return found, boundaries
+
+
+def writePeakTable(path, positions, relativePositions, heights, unit, reference):
+    with open(path, "w") as f:
+        print("Location (Absolute) [" + unit + "],Location (Relative to " + reference + " Boundary) [" + unit + "],Height", file=f)
+        for position, relative, height in zip(positions, relativePositions, heights):
+            print(str(position) + "," + str(relative) + "," + str(height), file=f)
+
+
+def peakInfoHeader(channels, unit):
+    header = "ROI"
+    for channel in channels:
+        header += ("," + channel + " Number of Peaks"
+                   + "," + channel + " Average Peak Position (Absolute) [" + unit + "]"
+                   + "," + channel + " Average Peak Position (Relative to " + channels[0] + ") [" + unit + "]"
+                   + "," + channel + " Average Peak Amplitude")
+    return header
+
+
+def peakInfoRow(roiName, peaks):
+    row = roiName
+    for positions, relativePositions, heights in peaks:
+        if len(positions) == 0:
+            row += ",0,nan,nan,nan"
+        else:
+            row += "," + ",".join(str(value) for value in (len(positions), float(np.mean(positions)),
+                                                           float(np.mean(relativePositions)), float(np.mean(heights))))
+    return row
+
+
+def writeScenePeaks(scenePath, sceneName, roiNames, xs, profiles, channels, unit, finder, plots=True):
+    """
+    Finds the peaks of every ROI of a scene and writes them in the layout of Validation/CustomImage:
+        - ROI_n/Peaks/ROI_n_Channel_m_Peaks.csv -> Position, position relative to the reference boundary and height of each peak
+        - ROI_n/Peaks/Channel_m_Peaks.png -> The searched part of the profile with its peaks (if plots)
+        - <scene>_PeakInfo.csv -> Number, average position and average height of the peaks of every ROI and channel
+    Input:
+        - roiNames, xs, profiles -> ROI names with the distances and per channel profiles of each ROI
+        - channels -> Channel names, the first one is the reference channel
+        - finder -> PeakFinder
+    Output: Peaks of every ROI and the boundary index of each ROI, see PeakFinder.find
+    """
+    scenePath = Path(scenePath)
+    if len(roiNames) == 0:
+        return [], []
+    found, boundaries = finder.find(xs, profiles)
+
+    with open(scenePath / Path(sceneName + "_PeakInfo.csv"), "w") as f:
+        print(peakInfoHeader(channels, unit), file=f)
+        for roiName, peaks in zip(roiNames, found):
+            print(peakInfoRow(roiName, peaks), file=f)
+
+    for roiName, x, profile, peaks, boundary in zip(roiNames, xs, profiles, found, boundaries):
+        peakPath = scenePath / roiName / Path("Peaks")
+        peakPath.mkdir(parents=True, exist_ok=True)
+        for channelIndex, (channel, (positions, relativePositions, heights)) in enumerate(zip(channels, peaks)):
+            writePeakTable(peakPath / Path(roiName + "_" + channel + "_Peaks.csv"), positions, relativePositions,
+                           heights, unit, channels[0])
+            if plots:
+                start = 0 if channelIndex == 0 else boundary
+                Plotting.sharedRenderer().peakPlot(x[start:], profile[channelIndex][start:], positions, heights, channel,
+                                                   roiName + " " + channel, unit, peakPath / Path(channel + "_Peaks.png"))
+    return found, boundaries
+
+
+def findRunPeaks(outputPath, finder, plots=True):
+    """
+    Searches the peaks of a finished run. For a folder tree the peaks of every scene are written as by
+    writeScenePeaks, for a ResultsStore (Profiles.parquet) they are written to Peaks.parquet.
+    Input:
+        - outputPath -> Output directory of a run
+        - finder -> PeakFinder
+        - plots -> Draw Channel_m_Peaks.png for every ROI and channel (folder tree only)
+    """
+    import ResultsStore
+
+    outputPath = Path(outputPath)
+    if (outputPath / ResultsStore.PROFILES_FILE).exists():
+        profiles, rois, metadata = ResultsStore.readStore(outputPath)
+        columns = []
+        for sceneName, sceneProfiles in profiles.groupby("scene", sort=False):
+            channels = list(dict.fromkeys(sceneProfiles["channel"]))
+            roiIds, xs, ys = [], [], []
+            for roi, profile in sceneProfiles.groupby("roi", sort=True):
+                nBins = len(profile) // len(channels)
+                roiIds.append(roi)
+                xs.append(profile["radius"].to_numpy()[:nBins])
+                ys.append(list(profile["mean"].to_numpy().reshape(len(channels), nBins)))
+            found, boundaries = finder.find(xs, ys)
+            columns.extend(ResultsStore.peakColumns(sceneName, roi, channels, peaks) for roi, peaks in zip(roiIds, found))
+        ResultsStore.writePeaks(outputPath, columns)
+        return
+
+    for scenePath in sorted(path for path in outputPath.iterdir() if path.is_dir()):
+        roiNames, xs, ys = [], [], []
+        for roiPath in Plotting.roiFolders(scenePath):
+            x, y, channels, unit = Plotting.readRadial(roiPath / "Radial.csv")
+            roiNames.append(roiPath.name)
+            xs.append(x)
+            ys.append(y)
+        if len(roiNames) != 0:
+            writeScenePeaks(scenePath, scenePath.name, roiNames, xs, ys, channels, unit, finder, plots)
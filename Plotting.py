@@ -0,0 +1,207 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+
+class PlotRenderer:
+    """
+    Draws radial profile plots on a single Agg figure that is reused for every plot, instead of creating a
+    new pyplot figure (and going through pyplot's global state) for each ROI.
+    """
+
+    def __init__(self):
+        # Imported here, so scripts only load matplotlib once they draw a plot
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        self.figure = Figure()
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.size = self.figure.get_size_inches()
+        self.axes = self.figure.add_subplot()
+
+    def profilePlot(self, x, y, channels, unit, path):
+        """
+        Plot of the radial profile of every channel of one ROI, see RadialProfileEngine.simplePlot.
+        """
+        self.axes.clear()
+        for yVals, channel in zip(y, channels):
+            self.axes.plot(x, yVals, label = channel)
+
+        self.axes.set_xlabel("Radius [" + unit + "]")
+        self.axes.set_ylabel("Normalized Intensity")
+        self.axes.legend()
+        self.figure.savefig(path)
+
+    def peakPlot(self, x, y, peaksX, peaksY, channel, title, unit, path):
+        """
+        Plot of the searched part of one channel's profile with its peaks marked, see Peaks.writeScenePeaks.
+        """
+        self.axes.clear()
+        self.axes.plot(x, y, label = channel)
+        self.axes.plot(peaksX, peaksY, "ro")
+        self.axes.set_title(title)
+        self.axes.set_xlabel("Distance [" + unit + "]")
+        self.axes.set_ylabel("Normalized Intensity")
+        self.axes.legend()
+        self.figure.savefig(path)
+        self.axes.set_title("")
+
+    def summaryPlot(self, profiles, channels, unit, path, title=None):
+        """
+        Plot of every ROI of a scene, one panel per channel. Each ROI is drawn as a thin line, together with
+        the mean profile of all ROIs (averaged over the ROIs that reach each radius).
+        Input:
+            - profiles -> List of (x, y) tuples, one per ROI, with y holding one array per channel
+            - channels -> Channel names, in the order of each y
+            - unit -> Unit of the x values
+            - path -> Path of the PNG
+            - title -> Optional title of the figure, usually the scene name
+        """
+        self.figure.clear()
+        self.figure.set_size_inches(self.size[0] * len(channels), self.size[1])
+        axes = self.figure.subplots(1, len(channels), squeeze=False)[0]
+
+        longest = max(range(len(profiles)), key=lambda index: len(profiles[index][0]))
+        xAll = profiles[longest][0]
+        for channelIndex, (ax, channel) in enumerate(zip(axes, channels)):
+            stacked = np.full((len(profiles), len(xAll)), np.nan)
+            for roiIndex, (x, y) in enumerate(profiles):
+                ax.plot(x, y[channelIndex], color="0.6", linewidth=0.5, alpha=0.5)
+                stacked[roiIndex, :len(x)] = y[channelIndex]
+
+            ax.plot(xAll, np.nanmean(stacked, axis=0), color="C0", linewidth=2,
+                    label="Mean (" + str(len(profiles)) + " ROIs)")
+            ax.set_title(channel)
+            ax.set_xlabel("Radius [" + unit + "]")
+            ax.set_ylabel("Normalized Intensity")
+            ax.legend()
+
+        if title is not None:
+            self.figure.suptitle(title)
+        self.figure.savefig(path)
+
+        # Back to the single axes used by profilePlot
+        self.figure.clear()
+        self.figure.set_size_inches(self.size)
+        self.axes = self.figure.add_subplot()
+
+
+# Renderer shared by every plot drawn in a thread, a figure cannot be drawn on by several threads at once
+renderers = threading.local()
+
+
+def sharedRenderer():
+    if getattr(renderers, "renderer", None) is None:
+        renderers.renderer = PlotRenderer()
+    return renderers.renderer
+
+
+def readRadial(path):
+    """
+    Reads a Radial.csv file written by RadialProfileEngine.writeRadial.
+    Output:
+        - x values
+        - List of y values, one array per channel
+        - Channel names
+        - Unit of the x values
+    """
+    with open(path) as f:
+        header = f.readline().strip().split(",")
+    values = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    unit = header[0][header[0].find("[") + 1:header[0].rfind("]")]
+    return values[:, 0], list(values[:, 1:].T), header[1:], unit
+
+
+def roiFolders(scenePath):
+    """
+    ROI_n folders of a scene holding a Radial.csv, in ROI order.
+    """
+    folders = [path for path in Path(scenePath).glob("ROI_*") if (path / "Radial.csv").exists()]
+    return sorted(folders, key=lambda path: int(path.name.split("_")[-1]))
+
+
+def renderROIs(roiPaths):
+    """
+    Draws RadialPlot.png for each of the given ROI folders from its Radial.csv.
+    """
+    plotter = sharedRenderer()
+    for roiPath in roiPaths:
+        x, y, channels, unit = readRadial(roiPath / "Radial.csv")
+        plotter.profilePlot(x, y, channels, unit, roiPath / "RadialPlot.png")
+
+
+def renderSummary(profiles, channels, unit, path, title):
+    sharedRenderer().summaryPlot(profiles, channels, unit, path, title)
+
+
+def renderSceneSummary(scenePath):
+    """
+    Draws <scene>_Summary.png from the Radial.csv files of every ROI of a scene.
+    """
+    scenePath = Path(scenePath)
+    profiles = []
+    for roiPath in roiFolders(scenePath):
+        x, y, channels, unit = readRadial(roiPath / "Radial.csv")
+        profiles.append((x, y))
+    if len(profiles) != 0:
+        renderSummary(profiles, channels, unit, scenePath / Path(scenePath.name + "_Summary.png"), scenePath.name)
+
+
+def storeSummaries(storePath):
+    """
+    Summary plot arguments for every scene of a ResultsStore.
+    """
+    import ResultsStore
+
+    profiles, rois, metadata = ResultsStore.readStore(storePath)
+    tasks = []
+    for sceneName, sceneProfiles in profiles.groupby("scene", sort=False):
+        channels = list(dict.fromkeys(sceneProfiles["channel"]))
+        sceneData = []
+        for roi, profile in sceneProfiles.groupby("roi", sort=True):
+            nBins = len(profile) // len(channels)
+            sceneData.append((profile["radius"].to_numpy()[:nBins],
+                              list(profile["mean"].to_numpy().reshape(len(channels), nBins))))
+        scenePath = Path(storePath) / sceneName
+        scenePath.mkdir(parents=True, exist_ok=True)
+        tasks.append((sceneData, channels, metadata["unit"], scenePath / Path(sceneName + "_Summary.png"), sceneName))
+    return tasks
+
+
+def renderPlots(outputPath, workers=1, roiPlots=True, summary=True, chunkSize=64):
+    """
+    Render stage run after the analysis: draws the plots of a run from its stored profiles.
+    For a folder tree RadialPlot.png is drawn for every ROI (if roiPlots) and <scene>_Summary.png for every
+    scene (if summary). For a ResultsStore (Profiles.parquet) only the scene summaries are drawn.
+    Input:
+        - outputPath -> Output directory of a run
+        - workers -> Number of processes plots are rendered in, each reusing its own figure
+        - chunkSize -> Number of ROI plots rendered per task
+    """
+    import ResultsStore
+
+    outputPath = Path(outputPath)
+    tasks = []
+    if (outputPath / ResultsStore.PROFILES_FILE).exists():
+        if summary:
+            tasks.extend((renderSummary, args) for args in storeSummaries(outputPath))
+    else:
+        for scenePath in sorted(path for path in outputPath.iterdir() if path.is_dir()):
+            rois = roiFolders(scenePath)
+            if roiPlots:
+                tasks.extend((renderROIs, (rois[start:start + chunkSize],)) for start in range(0, len(rois), chunkSize))
+            if summary:
+                tasks.append((renderSceneSummary, (scenePath,)))
+
+    if workers <= 1:
+        for function, args in tasks:
+            function(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, max(1, len(tasks))),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        for future in [pool.submit(function, *args) for function, args in tasks]:
+            future.result()
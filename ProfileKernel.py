@@ -0,0 +1,262 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Memory the cached radius index maps may use in total
+INDEX_CACHE_BYTES = 128 * 2**20
+
+# Number of pixels stackProfiles reduces in a single bincount
+STACK_CHUNK_PIXELS = 1 << 22
+
+
+def radiusIndex(shape, center, binSize=1):
+    """
+    Integer radius bin of every pixel of a crop.
+    Input:
+        - shape -> (Y, X) shape of the crop
+        - center -> (Y, X) center point relative to the crop
+        - binSize -> Width of each radius bin in pixels
+    Output:
+        - (Y, X) int array holding floor(distance / binSize) for each pixel
+    """
+    centerY, centerX = center
+    if not (0 <= centerY < shape[0] and 0 <= centerX < shape[1]):
+        raise ValueError("Center is outside image")
+
+    dy = np.arange(shape[0], dtype=float) - centerY
+    dx = np.arange(shape[1], dtype=float) - centerX
+    distance = np.add.outer(dy * dy, dx * dx)
+    np.sqrt(distance, out=distance)
+    if binSize != 1:
+        distance /= binSize
+    # Distances are never negative, so truncation is the same as floor
+    return distance.astype(np.intp)
+
+
+def sectorIndex(shape, center, sectors):
+    """
+    Angular sector of every pixel of a crop.
+    Angles are measured around the center from the +X axis towards +Y (clockwise as displayed, since Y points down),
+    sector s covering angles from s * 360 / sectors up to (s + 1) * 360 / sectors degrees. The center pixel is in sector 0.
+    Input:
+        - shape -> (Y, X) shape of the crop
+        - center -> (Y, X) center point relative to the crop
+        - sectors -> Number of sectors
+    Output:
+        - (Y, X) int array of the sector of each pixel
+    """
+    centerY, centerX = center
+    dy = np.arange(shape[0], dtype=float) - centerY
+    dx = np.arange(shape[1], dtype=float) - centerX
+    angle = np.arctan2(dy[:, None], dx[None, :]) % (2 * np.pi)
+    index = (angle * (sectors / (2 * np.pi))).astype(np.intp)
+    # Angles just below 2 pi can round up to the sector after the last one
+    return np.minimum(index, sectors - 1, out=index)
+
+
+def sectorAngles(sectors):
+    """
+    Angle in degrees at which each sector starts, see sectorIndex.
+    """
+    return np.arange(sectors) * (360.0 / sectors)
+
+
+def binIndex(shape, center, binSize=1, sectors=1):
+    """
+    Flattened bin of every pixel of a crop and the number of pixels in each bin. With several sectors,
+    pixel bins are sector * nBins + radius bin, so (sector, radius) bins are reduced by a single bincount.
+    Output:
+        - Flattened bin index of every pixel
+        - Number of pixels in each bin, sectors * nBins values
+    """
+    index = radiusIndex(shape, center, binSize).ravel()
+    if sectors > 1:
+        nBins = int(index.max()) + 1
+        index += sectorIndex(shape, center, sectors).ravel() * nBins
+        return index, np.bincount(index, minlength=sectors * nBins)
+    return index, np.bincount(index)
+
+
+class IndexCache:
+    """
+    Least recently used cache of flattened radius (or sector and radius) index maps and their per bin pixel counts.
+    Fixed size ROIs share the same crop shape and relative center, so their maps only have to be computed once.
+    Maps are keyed by crop shape, relative center, bin size and number of sectors (bins are in pixels, so the pixel
+    size does not change them). Maps larger than maxBytes are computed but not cached.
+    Inputs:
+        - maxBytes -> Memory the cached maps may use in total, the least recently used maps are evicted beyond it
+    """
+
+    def __init__(self, maxBytes=INDEX_CACHE_BYTES):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The GUI profiles on a worker thread
+        self.lock = threading.Lock()
+
+    def get(self, shape, center, binSize=1, sectors=1):
+        """
+        Output:
+            - Flattened (read only) bin index of every pixel, see binIndex
+            - Number of pixels in each bin
+        """
+        key = (tuple(shape), tuple(center), binSize, sectors)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        index, counts = binIndex(shape, center, binSize, sectors)
+        index.setflags(write=False)
+        counts.setflags(write=False)
+        entry = (index, counts)
+
+        size = index.nbytes + counts.nbytes
+        if size <= self.maxBytes:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = entry
+                    self.bytes += size
+                while self.bytes > self.maxBytes:
+                    evicted, (evictedIndex, evictedCounts) = self.entries.popitem(last=False)
+                    self.bytes -= evictedIndex.nbytes + evictedCounts.nbytes
+                    self.evictions += 1
+        return entry
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.bytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+# Cache shared by every profile computed in this process
+indexCache = IndexCache()
+
+
+def radialProfiles(crops, center, binSize=1, cache=indexCache):
+    """
+    Radial mean of several channels of the same crop in a single grouped reduction.
+    Pixels are binned by their distance from the center exactly as dip.RadialMean does: every pixel of
+    the crop (including masked pixels set to zero) contributes to the ring it falls in, and bins run
+    from the center to the furthest corner of the crop.
+    Input:
+        - crops -> (C, Y, X) array or list of C (Y, X) crops sharing the same center
+        - center -> (Y, X) center point relative to the crop
+        - binSize -> Width of each radius bin in pixels
+        - cache -> IndexCache the radius index map is taken from, None to always compute it
+    Output:
+        - (C, nBins) float64 array of mean intensities per radius bin
+        - (nBins,) int array with the number of pixels in each radius bin
+    """
+    crops = np.asarray(crops)
+    if crops.ndim == 2:
+        crops = crops[None]
+
+    # The bin map and its pixel counts are shared by every channel (and by every crop of the same geometry)
+    if cache is not None:
+        index, counts = cache.get(crops.shape[-2:], center, binSize)
+    else:
+        index = radiusIndex(crops.shape[-2:], center, binSize).ravel()
+        counts = np.bincount(index)
+    nBins = len(counts)
+
+    sums = np.empty((crops.shape[0], nBins), dtype=np.float64)
+    for channel, crop in enumerate(crops):
+        sums[channel] = np.bincount(index, weights=crop.ravel(), minlength=nBins)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(counts > 0, sums / counts, 0.0)
+
+    return means, counts
+
+
+def stackProfiles(crops, center, binSize=1, cache=indexCache):
+    """
+    Radial means of a whole stack of crops sharing the same center and mask, e.g. every timepoint, Z-Plane
+    and channel of an ROI. The bin map is computed (or taken from the cache) once, and each plane gets its own
+    range of bins so that many planes are reduced by a single bincount.
+    Input:
+        - crops -> (..., Y, X) array, e.g. (T, Z, C, Y, X)
+        - center, binSize, cache -> See radialProfiles
+    Output:
+        - (..., nBins) float64 array of mean intensities per radius bin
+        - (nBins,) int array with the number of pixels in each radius bin
+    """
+    crops = np.asarray(crops)
+    leading = crops.shape[:-2]
+
+    if cache is not None:
+        index, counts = cache.get(crops.shape[-2:], center, binSize)
+    else:
+        index = radiusIndex(crops.shape[-2:], center, binSize).ravel()
+        counts = np.bincount(index)
+    nBins = len(counts)
+
+    planes = crops.reshape(-1, index.size)
+    sums = np.empty((len(planes), nBins), dtype=np.float64)
+    # Planes are reduced in chunks so the combined bin index stays small
+    chunk = max(1, STACK_CHUNK_PIXELS // max(1, index.size))
+    offsets = np.arange(min(chunk, len(planes)))[:, None] * nBins
+    for start in range(0, len(planes), chunk):
+        block = planes[start:start + chunk]
+        flatIndex = (offsets[:len(block)] + index).ravel()
+        sums[start:start + len(block)] = np.bincount(flatIndex, weights=block.ravel(),
+                                                     minlength=len(block) * nBins).reshape(len(block), nBins)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(counts > 0, sums / counts, 0.0)
+
+    return means.reshape(leading + (nBins,)), counts
+
+
+def sectorProfiles(crops, center, sectors, binSize=1, cache=indexCache):
+    """
+    Mean of several channels of the same crop in every (sector, radius) bin, see sectorIndex, computed in a
+    single grouped reduction per channel. The isotropic radial mean is the marginal over the sectors: the sums
+    and pixel counts of a radius are added up over all sectors, so it holds the same values as radialProfiles.
+    Input:
+        - crops -> (C, Y, X) array or list of C (Y, X) crops sharing the same center
+        - center -> (Y, X) center point relative to the crop
+        - sectors -> Number of angular sectors
+        - binSize, cache -> See radialProfiles
+    Output:
+        - (C, sectors, nBins) float64 array of mean intensities per sector and radius bin
+        - (sectors, nBins) int array with the number of pixels in each bin
+        - (C, nBins) float64 array of isotropic mean intensities per radius bin
+        - (nBins,) int array with the number of pixels in each radius bin
+    """
+    crops = np.asarray(crops)
+    if crops.ndim == 2:
+        crops = crops[None]
+
+    if cache is not None:
+        index, counts = cache.get(crops.shape[-2:], center, binSize, sectors)
+    else:
+        index, counts = binIndex(crops.shape[-2:], center, binSize, sectors)
+    nBins = len(counts) // sectors
+
+    sums = np.empty((crops.shape[0], len(counts)), dtype=np.float64)
+    for channel, crop in enumerate(crops):
+        sums[channel] = np.bincount(index, weights=crop.ravel(), minlength=len(counts))
+    sums = sums.reshape(crops.shape[0], sectors, nBins)
+    counts = counts.reshape(sectors, nBins)
+    radialSums = sums.sum(axis=1)
+    radialCounts = counts.sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(counts > 0, sums / counts, 0.0)
+        radialMeans = np.where(radialCounts > 0, radialSums / radialCounts, 0.0)
+
+    return means, counts, radialMeans, radialCounts
@@ -0,0 +1,93 @@
+class ImageOptions:
+    """
+    How the planes of each scene are read.
+    Inputs:
+        - maxIntensity -> Project across Z instead of using the ROI's Z-Plane
+        - projection, zRange, threads -> Projection used when maxIntensity is set, see ImageAccess.SceneReader
+        - backend -> Backend worker processes open the image with, see ImageAccess.openImage
+    """
+
+    def __init__(self, maxIntensity=False, projection="max", zRange=None, threads=1, backend="auto"):
+        self.maxIntensity = maxIntensity
+        self.projection = projection
+        self.zRange = zRange
+        self.threads = threads
+        self.backend = backend
+
+
+class BackgroundOptions:
+    """
+    Background subtraction of the ROI crops.
+    Inputs:
+        - subtract -> Subtract the background of the background channels
+        - channels -> Names of the channels that are background subtracted
+        - stdDevs -> Standard deviations above the background mean that are subtracted
+        - method, step, sampleSize -> Background estimator and subsampling, see Background.estimate and
+          Background.samplePlane. The defaults fit a Gaussian to every pixel.
+    """
+
+    def __init__(self, subtract=False, channels=(), stdDevs=0, method="gaussian", step=1, sampleSize=None):
+        self.subtract = subtract
+        self.channels = list(channels)
+        self.stdDevs = stdDevs
+        self.method = method
+        self.step = step
+        self.sampleSize = sampleSize
+
+
+class OutputOptions:
+    """
+    What is written for each ROI and how.
+    Inputs:
+        - format -> "tree" writes a folder per ROI, "parquet" writes every profile and ROI of the run to a
+          ResultsStore in the output directory instead
+        - plots -> Draw RadialPlot.png for every ROI while profiling. Plots can instead be drawn afterwards
+          by Plotting.renderPlots
+        - incremental -> Only profile ROIs that are new or changed since the last run into the same output
+          directory, see HeadlessProfiler.planScene. Only used with the tree output format.
+        - writerThreads -> Threads the files of each ROI are written on while the next ROIs are profiled
+          (see OutputWriter), 0 writes them in the profiling thread
+        - tiffCompression -> Optional tifffile compression of the cropped ROI TIFFs, e.g. "zlib"
+    """
+
+    def __init__(self, format="tree", plots=True, incremental=True, writerThreads=2, tiffCompression=None):
+        self.format = format
+        self.plots = plots
+        self.incremental = incremental
+        self.writerThreads = writerThreads
+        self.tiffCompression = tiffCompression
+
+
+class AnalysisOptions:
+    """
+    Analyses done in addition to the radial profile of each ROI.
+    Inputs:
+        - stack -> Also profile every ROI at every timepoint and Z-Plane (within zRange, regardless of the projection).
+          The (T, Z, channel, radius) profiles are written to RadialStack.npz, or to the ResultsStore.
+        - sectors -> If above 1, every ROI is also profiled in this many angular sectors around its center
+          (see RadialProfileEngine.sectorProfiles), written to RadialSectors.npz. The isotropic profile is then the
+          marginal of the sectors.
+        - peakFinder -> Optional Peaks.PeakFinder. The peaks of every profile of a scene are then searched together
+          once the scene is profiled, see HeadlessProfiler.findPeaks
+    """
+
+    def __init__(self, stack=False, sectors=0, peakFinder=None):
+        self.stack = stack
+        self.sectors = sectors
+        self.peakFinder = peakFinder
+
+
+class InstrumentationOptions:
+    """
+    Timing and profiling output of each scene.
+    Inputs:
+        - timings -> Write <scene>_Timings.json with the time spent in each stage, ROI counters and peak memory
+        - traceMemory -> Also record the peak memory allocated within each stage (slower), see Instrumentation.Timings
+        - cProfile -> Write a cProfile dump of each scene to <scene>_Profile.prof. With several workers
+          only the main process (planning, background and writing the tables) is profiled.
+    """
+
+    def __init__(self, timings=False, traceMemory=False, cProfile=False):
+        self.timings = timings
+        self.traceMemory = traceMemory
+        self.cProfile = cProfile
@@ -0,0 +1,47 @@
+import queue
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+class ProfileWorker(QThread):
+    """
+    Profiles the scenes of a RadialProfiler on a separate thread, so the window stays responsive and the next
+    scene can be drawn in Napari while the previous one is still being profiled.
+    Scenes are taken from queue as (rois, scenePath, sceneName, reader) tuples (see RadialProfiler.sceneQueue)
+    until None is put on it. Once the profiler is cancelled the remaining scenes are skipped, but the thread only
+    finishes at None, so it never finishes while viewers are still open.
+    Signals:
+        - progress -> (sceneName, roisDone, roisTotal) while a scene is profiled
+        - sceneDone -> (sceneName, scenesDone) after each scene
+    """
+
+    progress = pyqtSignal(str, int, int)
+    sceneDone = pyqtSignal(str, int)
+
+    def __init__(self, profiler, parent=None):
+        super(ProfileWorker, self).__init__(parent)
+        self.profiler = profiler
+        self.queue = queue.Queue()
+        self.profiler.sceneQueue = self.queue
+        # Called from this thread, the signal hands the progress over to the GUI thread
+        self.profiler.progressCallback = self.progress.emit
+
+    def run(self):
+        scenesDone = 0
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.profiler.closeWriter()
+                return
+            if self.profiler.cancelled():
+                continue
+
+            rois, scenePath, sceneName, reader = job
+            try:
+                self.profiler.profileScene(rois, scenePath, sceneName, reader)
+            except Exception as e:
+                print("Scene", sceneName, "could not be profiled")
+                print(e)
+
+            scenesDone += 1
+            self.sceneDone.emit(sceneName, scenesDone)
@@ -0,0 +1,212 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+class ROI:
+    """
+    Container for a single ROI and the center point used for its radial profile.
+    Attributes:
+        - vertices -> (N, 2) array of (Y, X) vertex coordinates, as stored by a Napari shapes layer
+        - shapeType -> Napari shape type of the ROI (polygon, rectangle, ellipse, path or line)
+        - center -> (Y, X) center point of the radial profile
+        - z -> Z-Plane the ROI was drawn on (None if a maximum intensity projection was used)
+    """
+
+    def __init__(self, vertices, shapeType, center, z=None):
+        self.vertices = np.asarray(vertices, dtype=float).reshape(-1, 2)
+        self.shapeType = str(shapeType)
+        self.center = (float(center[0]), float(center[1]))
+        self.z = z
+
+
+def parseZ(z):
+    """
+    Z values are written to _Table.csv with str(), so a maximum intensity projection is stored as "None".
+    Returns an int Z-Plane or None.
+    """
+    if z is None:
+        return None
+    if isinstance(z, float) and np.isnan(z):
+        return None
+    if str(z) in ("None", "nan", ""):
+        return None
+    return int(float(z))
+
+
+def roiIndexPath(scenePath, sceneName):
+    return Path(scenePath) / Path(sceneName + "_ROIs.npz")
+
+
+def writeROIIndex(path, names, rois):
+    """
+    Writes the ROIs of a scene to a single binary index, which is read back in one go by readROIIndex.
+    The vertices of all ROIs are stored end to end, ROI i owns vertices[offsets[i]:offsets[i + 1]].
+    Input:
+        - path -> Path of the .npz index (see roiIndexPath)
+        - names -> ROI folder names (ROI_n), in table order
+        - rois -> ROI objects, centers as written to the absolute center columns of _Table.csv
+    """
+    lengths = [len(roi.vertices) for roi in rois]
+    np.savez(path,
+             names=np.asarray(names, dtype=str),
+             shapes=np.asarray([roi.shapeType for roi in rois], dtype=str),
+             vertices=np.concatenate([roi.vertices for roi in rois]) if len(rois) != 0 else np.zeros((0, 2)),
+             offsets=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+             centers=np.asarray([roi.center for roi in rois], dtype=np.float64).reshape(-1, 2),
+             # -1 marks ROIs drawn on a maximum intensity projection
+             z=np.asarray([-1 if roi.z is None else roi.z for roi in rois], dtype=np.int64))
+
+
+def readROIIndex(path):
+    """
+    Reads an index written by writeROIIndex.
+    Output:
+        - ROI names and ROI objects in table order
+    """
+    with np.load(path, allow_pickle=False) as index:
+        names, shapes, vertices = index["names"], index["shapes"], index["vertices"]
+        offsets, centers, zs = index["offsets"], index["centers"], index["z"]
+    rois = [ROI(vertices[start:stop], shape, center, None if z < 0 else int(z))
+            for start, stop, shape, center, z in zip(offsets[:-1], offsets[1:], shapes, centers, zs)]
+    return [str(name) for name in names], rois
+
+
+def loadTableROIs(scenePath, sceneName):
+    """
+    Reads the ROIs of a scene from <sceneName>_Table.csv and every ROI_n_Coordinates.csv.
+    Output:
+        - ROI names and ROI objects in the order they appear in the master table
+    """
+    import pandas as pd
+
+    scenePath = Path(scenePath)
+    masterTable = pd.read_csv(scenePath / Path(sceneName + "_Table.csv"))
+
+    rois = []
+    # The Absolute Center columns hold the X and Y values swapped relative to their header (see executeScript),
+    # so "AbsoluteCenterY" is the X coordinate and "AbsoluteCenterX" is the Y coordinate.
+    for centerY, centerX, roi, shape, z in zip(masterTable["AbsoluteCenterY"], masterTable["AbsoluteCenterX"],
+                                               masterTable["ROI"], masterTable["Shape"], masterTable["Z"]):
+        vertices = np.loadtxt(scenePath / Path(roi) / Path(roi + "_Coordinates.csv"), delimiter=",")
+        rois.append(ROI(vertices, shape, (int(centerX), int(centerY)), parseZ(z)))
+
+    return [str(roi) for roi in masterTable["ROI"]], rois
+
+
+def convertScene(scenePath, sceneName):
+    """
+    Builds the binary ROI index of a scene written before indexes existed, from its per ROI CSV files.
+    Output:
+        - ROI names and ROI objects, see loadTableROIs
+    """
+    names, rois = loadTableROIs(scenePath, sceneName)
+    writeROIIndex(roiIndexPath(scenePath, sceneName), names, rois)
+    return names, rois
+
+
+def loadPreviousROIs(scenePath, sceneName):
+    """
+    Reads the ROIs written by a previous run. They are read from the scene's binary ROI index (<sceneName>_ROIs.npz)
+    unless the index is missing or older than <sceneName>_Table.csv, in which case they are read from the table and
+    every ROI_n_Coordinates.csv and the index is (re)built from them.
+    Input:
+        - scenePath -> Path of the scene folder of a previous run
+        - sceneName -> Scene folder name, used as the prefix of the master table
+    Output:
+        - List of ROI objects in the order they appear in the master table
+    """
+    indexPath = roiIndexPath(scenePath, sceneName)
+    tablePath = Path(scenePath) / Path(sceneName + "_Table.csv")
+    if indexPath.exists() and (not tablePath.exists() or indexPath.stat().st_mtime >= tablePath.stat().st_mtime):
+        return readROIIndex(indexPath)[1]
+
+    names, rois = loadTableROIs(scenePath, sceneName)
+    try:
+        writeROIIndex(indexPath, names, rois)
+    except OSError as e:
+        print("ROI index could not be written for", sceneName)
+        print(e)
+    return rois
+
+
+def roiFromDict(entry):
+    """
+    Builds an ROI from a JSON dictionary of the form:
+        {"shape": "polygon", "vertices": [[y, x], ...], "center": [y, x], "z": 0}
+    If no center is given, the mean of the vertices is used.
+    """
+    vertices = np.asarray(entry["vertices"], dtype=float)
+    center = entry.get("center")
+    if center is None:
+        center = vertices.mean(axis=0)
+    return ROI(vertices, entry.get("shape", "polygon"), center, parseZ(entry.get("z")))
+
+
+def roiFromFeature(feature):
+    """
+    Builds an ROI from a GeoJSON Feature. GeoJSON stores coordinates as (X, Y) so they are flipped
+    into the (Y, X) order used everywhere else. Polygons use their exterior ring and LineStrings become paths.
+    The optional "center" property is also given as (X, Y).
+    """
+    geometry = feature["geometry"]
+    properties = feature.get("properties") or {}
+
+    if geometry["type"] == "Polygon":
+        ring = np.asarray(geometry["coordinates"][0], dtype=float)
+        # GeoJSON rings are closed, Napari polygons are not
+        if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+            ring = ring[:-1]
+        shape = properties.get("shape", "polygon")
+    elif geometry["type"] == "LineString":
+        ring = np.asarray(geometry["coordinates"], dtype=float)
+        shape = properties.get("shape", "path")
+    else:
+        raise ValueError("Unsupported GeoJSON geometry: " + str(geometry["type"]))
+
+    vertices = ring[:, ::-1]
+    center = properties.get("center")
+    if center is None:
+        center = vertices.mean(axis=0)
+    else:
+        center = (center[1], center[0])
+
+    return ROI(vertices, shape, center, parseZ(properties.get("z")))
+
+
+def loadROIFile(path, sceneName):
+    """
+    Reads ROIs for a single scene from a JSON or GeoJSON file.
+    Input:
+        - path -> Path to a .json or .geojson file
+        - sceneName -> Scene the ROIs are requested for
+    Output:
+        - List of ROI objects
+
+    Accepted layouts:
+        - JSON list of ROI dictionaries (used for every scene)
+        - JSON dictionary mapping scene names to lists of ROI dictionaries
+        - GeoJSON FeatureCollection, list of Features or single Feature. Features with a "scene"
+          property are only used for that scene.
+    """
+    with open(path, "r") as f:
+        contents = json.load(f)
+
+    if isinstance(contents, dict) and contents.get("type") == "FeatureCollection":
+        features = contents["features"]
+    elif isinstance(contents, dict) and contents.get("type") == "Feature":
+        features = [contents]
+    elif isinstance(contents, list) and len(contents) != 0 and contents[0].get("type") == "Feature":
+        features = contents
+    else:
+        features = None
+
+    if features is not None:
+        return [roiFromFeature(feature) for feature in features
+                if (feature.get("properties") or {}).get("scene", sceneName) == sceneName]
+
+    if isinstance(contents, dict):
+        contents = contents.get(sceneName, [])
+
+    return [roiFromDict(entry) for entry in contents]
@@ -0,0 +1,138 @@
+import numpy as np
+
+
+def rectangleAxes(corners):
+    """
+    Napari stores rectangles and ellipses as the 4 corners of their (possibly rotated) bounding box,
+    in no guaranteed order. Returns the center and the two half-side vectors of that box.
+    """
+    corners = np.asarray(corners, dtype=float)
+    center = corners.mean(axis=0)
+    # The two corners closest to the first corner share an edge with it, the furthest one is the diagonal.
+    order = np.argsort(np.linalg.norm(corners[1:] - corners[0], axis=1)) + 1
+    halfA = (corners[order[0]] - corners[0]) / 2
+    halfB = (corners[order[1]] - corners[0]) / 2
+    return center, halfA, halfB
+
+
+def shapePolygon(vertices, shapeType, segments=100):
+    """
+    Converts Napari shape data into the polygon that is rasterized for its mask.
+    Input:
+        - vertices -> (N, 2) array of (Y, X) coordinates
+        - shapeType -> Napari shape type
+        - segments -> Number of points used to approximate an ellipse (matches Napari's triangulation)
+    Output:
+        - (M, 2) array of polygon vertices
+    """
+    vertices = np.asarray(vertices, dtype=float)
+
+    if shapeType == "ellipse":
+        center, halfA, halfB = rectangleAxes(vertices)
+        theta = np.linspace(0, 2 * np.pi, segments)
+        return center + np.cos(theta)[:, None] * halfA + np.sin(theta)[:, None] * halfB
+
+    if shapeType == "rectangle":
+        center, halfA, halfB = rectangleAxes(vertices)
+        return center + np.array([-halfA - halfB, halfA - halfB, halfA + halfB, -halfA + halfB])
+
+    return vertices
+
+
+def polygonMask(polygon, maskShape):
+    """
+    Even-odd rasterization of a polygon sampled at integer pixel coordinates.
+    Input:
+        - polygon -> (N, 2) array of (Y, X) vertices
+        - maskShape -> (Y, X) shape of the mask
+    Output:
+        - Boolean mask of shape maskShape
+    """
+    rows, cols = maskShape
+    mask = np.zeros((rows, cols), dtype=bool)
+    if len(polygon) < 3 or rows == 0 or cols == 0:
+        return mask
+
+    y0, x0 = polygon[:, 0], polygon[:, 1]
+    y1, x1 = np.roll(y0, -1), np.roll(x0, -1)
+
+    # Intersections of every edge with every pixel row, using a half open rule so shared vertices count once.
+    rr = np.arange(rows, dtype=float)[:, None]
+    crosses = (y0 <= rr) != (y1 <= rr)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xCross = x0 + (rr - y0) * (x1 - x0) / (y1 - y0)
+    xCross = np.where(crosses, xCross, np.inf)
+    xCross.sort(axis=1)
+
+    # Sorted crossings come in (enter, exit) pairs. Mark them in a difference array and accumulate along each row.
+    # Rows with fewer pairs are padded with infinity, which is clipped to the last column and cancels out.
+    nPairs = crosses.sum(axis=1).max() // 2
+    if nPairs == 0:
+        return mask
+    starts = np.clip(np.ceil(xCross[:, 0:2 * nPairs:2]), 0, cols).astype(int)
+    stops = np.clip(np.ceil(xCross[:, 1:2 * nPairs:2]), 0, cols).astype(int)
+    rowIndex = np.broadcast_to(np.arange(rows)[:, None], starts.shape)
+
+    edges = np.zeros((rows, cols + 1), dtype=np.int32)
+    np.add.at(edges, (rowIndex, starts), 1)
+    np.add.at(edges, (rowIndex, stops), -1)
+    mask[:] = np.cumsum(edges, axis=1)[:, :cols] > 0
+    return mask
+
+
+def pathMask(vertices, maskShape):
+    """
+    Paths and lines have no area, so the pixels they pass through are used as the mask.
+    """
+    mask = np.zeros(maskShape, dtype=bool)
+    for start, stop in zip(vertices[:-1], vertices[1:]):
+        steps = int(np.ceil(np.abs(stop - start).max())) + 1
+        points = np.rint(np.linspace(start, stop, steps)).astype(int)
+        inside = ((points[:, 0] >= 0) & (points[:, 0] < maskShape[0]) &
+                  (points[:, 1] >= 0) & (points[:, 1] < maskShape[1]))
+        mask[points[inside, 0], points[inside, 1]] = True
+    return mask
+
+
+def cropBounds(vertices, y, x):
+    """
+    Get Min and Max x and y coordinates of an ROI, clipped to an image of shape (y, x).
+    Output: ymin, ymax, xmin, xmax
+    """
+    ymin, xmin = np.min(vertices, axis=0).astype(int)
+    ymax, xmax = np.max(vertices, axis=0).astype(int)
+
+    xmin = min(max(xmin, 0), x)
+    xmax = min(max(xmax, 0), x)
+    ymin = min(max(ymin, 0), y)
+    ymax = min(max(ymax, 0), y)
+
+    return ymin, ymax, xmin, xmax
+
+
+def shapeToMask(vertices, shapeType, maskShape, offset=(0, 0)):
+    """
+    Rasterizes a single Napari shape into a boolean mask of the given (Y, X) shape.
+    offset is the (Y, X) image coordinate of the mask's first pixel.
+    """
+    vertices = np.asarray(vertices, dtype=float) - np.asarray(offset, dtype=float)
+    if shapeType in ("path", "line"):
+        return pathMask(vertices, maskShape)
+    return polygonMask(shapePolygon(vertices, shapeType), maskShape)
+
+
+def localMask(vertices, shapeType, imageShape):
+    """
+    Rasterizes a shape only within its bounding box, clipped to the image.
+    Input:
+        - vertices -> (N, 2) array of (Y, X) coordinates
+        - shapeType -> Napari shape type
+        - imageShape -> (Y, X) shape of the image
+    Output:
+        - Boolean mask with the shape of the clipped bounding box
+        - (ymin, ymax, xmin, xmax) of the bounding box
+    """
+    bounds = cropBounds(vertices, imageShape[0], imageShape[1])
+    ymin, ymax, xmin, xmax = bounds
+    return shapeToMask(vertices, shapeType, (ymax - ymin, xmax - xmin), offset=(ymin, xmin)), bounds
+
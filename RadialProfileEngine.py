@@ -0,0 +1,999 @@
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import Background
+import ImageAccess
+import Instrumentation
+import Manifest
+import OutputWriter
+import Peaks
+import Plotting
+import ProfileKernel
+import ProfileOptions
+import ROILoader
+import ROIMasks
+import ResultsStore
+
+
+# Compressions of the cropped ROI TIFFs that tifffile can write without additional codecs
+TIFF_COMPRESSIONS = ("zlib", "lzma")
+
+
+def checkPath(path):
+    '''
+    Since the user specifies the output folder, new folders may need to be created.
+    This function takes a PathLib Path object as input and created a directory at the
+    path if it does not already exist.
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+        return False
+    else:
+        return True
+
+
+def folderName(scene):
+    """
+    Scene names can contain characters that are not valid in folder names.
+    """
+    return scene.replace(":","_").replace("/","_")
+
+
+def buildSceneDict(path, image):
+    """
+    Maps the friendly scene names shown to the user to the scene names of the AICSImage object.
+    .lif files already have descriptive scene names, other formats are named <file>_<index>.
+    """
+    path = Path(path)
+    if path.suffix != ".lif":
+        sceneNames = [str(path.name).split(".")[0] + "_" + str(index) for index in range(len(image.scenes))]
+        return {sceneName:scene for sceneName,scene in zip(sceneNames, image.scenes)}
+    else:
+        return {scene:scene for scene in image.scenes}
+
+
+def channelNames(nChannels):
+    return ["Channel_" + str(num+1) for num in range(nChannels)]
+
+
+def simplePlot(x, y, channels, unit, path):
+    """
+    Output a simple plot for quick visualization purposes.
+    Input:  List of 1 of x values with same length as each list in y
+            List of 1 or more lists of y values
+            Channel names for labels (should be length of x and y)
+            Unit of the x values
+            Path that includes a file name
+    Output: A Plot of radial profiles for each channel
+    The plot is drawn on the figure shared by every plot of this thread, see Plotting.PlotRenderer.
+    """
+    Plotting.sharedRenderer().profilePlot(x, y, channels, unit, path)
+
+
+def subtractThreshold(img, threshold):
+    """
+    Subtracts a background threshold, clipping values at zero to avoid underflow. The dtype is kept.
+    """
+    return np.clip(img - threshold, a_min = 0, a_max = None).astype(img.dtype)
+
+
+def backgroundImageName(z):
+    """
+    File name of the background subtracted image of Z-Plane z, None for projections.
+    """
+    if z is None:
+        return "BackgroundSubtractedImage.tif"
+    return "BackgroundSubtractedImage_Z" + str(z) + ".tif"
+
+
+def maskCrop(crop, localMask):
+    """
+    Zeroes the pixels of a bounding box crop that are outside of the ROI, keeping the dtype of the crop.
+    """
+    crop = np.asarray(crop)
+    return np.where(localMask, crop, crop.dtype.type(0))
+
+
+def cropROI(plane, localMask, bounds):
+    """
+    Crops the ROI's bounding box out of a 2D plane and zeroes the pixels outside of the ROI.
+    Only the bounding box is touched, so memory and time scale with the ROI area rather than the image size.
+    Input:
+        - plane -> 2D (Y, X) image
+        - localMask -> Boolean mask of the ROI with the shape of the bounding box
+        - bounds -> (ymin, ymax, xmin, xmax) of the bounding box
+    Output:
+        - Masked crop with the dtype of the plane
+    """
+    ymin, ymax, xmin, xmax = bounds
+    return maskCrop(plane[ymin:ymax,xmin:xmax], localMask)
+
+
+def radialProfiles(crops, center, bounds):
+    """
+    Radial mean of every channel of a cropped ROI, truncated at the longest distance from the center to an edge of the ROI.
+    Input:
+        - crops -> List of 2D masked ROI images, one per channel
+        - center -> Absolute (Y, X) center point as ints
+        - bounds -> (ymin, ymax, xmin, xmax) of the crop
+    Output:
+        - List of 1D numpy arrays of mean intensities per radius, one per channel
+        - 1D numpy array of the number of pixels at each radius
+    """
+    oldY, oldX = center
+    ymin, ymax, xmin, xmax = bounds
+    newX, newY = int(oldX - xmin), int(oldY - ymin)
+
+    rp, counts = ProfileKernel.radialProfiles(crops, (newY, newX))
+    nValues = min(profileLength(center, bounds), rp.shape[1])
+
+    return list(rp[:, :nValues]), counts[:nValues]
+
+
+def sectorProfiles(crops, center, bounds, sectors):
+    """
+    Radial means of every channel of a cropped ROI in each of several angular sectors, truncated as in radialProfiles.
+    The isotropic profile is computed in the same pass as the marginal over the sectors.
+    Input:
+        - crops, center, bounds -> See radialProfiles
+        - sectors -> Number of angular sectors, see ProfileKernel.sectorIndex
+    Output:
+        - List of 1D numpy arrays of isotropic mean intensities per radius, one per channel
+        - 1D numpy array of the number of pixels at each radius
+        - (channel, sector, radius) numpy array of mean intensities
+        - (sector, radius) numpy array of the number of pixels in each bin
+    """
+    oldY, oldX = center
+    ymin, ymax, xmin, xmax = bounds
+    newX, newY = int(oldX - xmin), int(oldY - ymin)
+
+    means, counts, rp, radialCounts = ProfileKernel.sectorProfiles(crops, (newY, newX), sectors)
+    nValues = min(profileLength(center, bounds), rp.shape[1])
+
+    return list(rp[:, :nValues]), radialCounts[:nValues], means[..., :nValues], counts[:, :nValues]
+
+
+def profileLength(center, bounds):
+    """
+    Find the longest distance from center to one of the edges and use that distance as the radius.
+    The radius itself is included, as it was when slicing the dip.Image returned by dip.RadialMean.
+    """
+    oldY, oldX = center
+    ymin, ymax, xmin, xmax = bounds
+    maxRads = [abs(xmin-oldX), abs(xmax-oldX), abs(ymin-oldY), abs(ymax-oldY)]
+    return int(max(maxRads)) + 1
+
+
+def stackProfiles(stack, center, bounds):
+    """
+    Radial means of every timepoint, Z-Plane and channel of a cropped ROI, truncated as in radialProfiles.
+    Input:
+        - stack -> (T, Z, C, Y, X) masked ROI crops
+        - center -> Absolute (Y, X) center point as ints
+        - bounds -> (ymin, ymax, xmin, xmax) of the crop
+    Output:
+        - (T, Z, C, radius) numpy array of mean intensities
+        - 1D numpy array of the number of pixels at each radius
+    """
+    oldY, oldX = center
+    ymin, ymax, xmin, xmax = bounds
+    newX, newY = int(oldX - xmin), int(oldY - ymin)
+
+    means, counts = ProfileKernel.stackProfiles(stack, (newY, newX))
+    nValues = min(profileLength(center, bounds), means.shape[-1])
+
+    return means[..., :nValues], counts[:nValues]
+
+
+def writeRadial(path, xRad, yRPs, channels, unit):
+    """
+    Writes Radial.csv with a Distance column followed by one column per channel.
+    """
+    # Every column is formatted at once and the file is written in a single call
+    columns = [np.asarray(xRad).astype(str)] + [np.asarray(yRP).astype(str) for yRP in yRPs]
+    lines = columns[0]
+    for column in columns[1:]:
+        lines = np.char.add(np.char.add(lines, ","), column)
+    with open(path, "w") as f:
+        f.write(",".join(["Distance [" + unit + "]"] + list(channels)) + "\n")
+        f.write("".join(line + "\n" for line in lines))
+
+
+def writeStack(path, xRad, zPlanes, profiles, counts, channels, unit):
+    """
+    Writes RadialStack.npz holding the (T, Z, channel, radius) profiles of an ROI together with the distance
+    of each radius, the Z-Plane of each Z index, the pixel count of each radius and the channel names.
+    """
+    np.savez(path, radius=np.asarray(xRad), z=np.asarray(zPlanes), profiles=profiles, counts=np.asarray(counts),
+             channels=np.asarray(channels), unit=np.asarray(unit))
+
+
+def writeCrops(roiPath, roiName, channels, crops, compression=None):
+    """
+    Writes the masked crop of every channel of an ROI to ROI_n_Channel_m.tiff, compressed with the given
+    tifffile compression (e.g. "zlib") if one is given.
+    """
+    import tifffile
+
+    for channel, cropped in zip(channels, crops):
+        tifffile.imwrite(roiPath / Path(roiName + "_" + channel + ".tiff"), cropped, compression=compression)
+
+
+def writeSectors(path, xRad, profiles, counts, channels, unit):
+    """
+    Writes RadialSectors.npz holding the (channel, sector, radius) profiles of an ROI together with the distance
+    of each radius, the angle in degrees at which each sector starts, the (sector, radius) pixel counts and
+    the channel names.
+    """
+    np.savez(path, radius=np.asarray(xRad), angles=ProfileKernel.sectorAngles(profiles.shape[1]), profiles=profiles,
+             counts=np.asarray(counts), channels=np.asarray(channels), unit=np.asarray(unit))
+
+
+def writeROIFiles(roiPath, roiName, vertices, xRad, yRPs, stack, sectors, channels, unit):
+    """
+    Writes ROI_n_Coordinates.csv, Radial.csv and, in stack and sector mode, RadialStack.npz and RadialSectors.npz of an ROI.
+    """
+    np.savetxt(roiPath / Path(roiName + "_Coordinates.csv"), vertices, delimiter=",")
+    writeRadial(roiPath / Path("Radial.csv"), xRad, yRPs, channels, unit)
+    if stack is not None:
+        writeStack(roiPath / Path("RadialStack.npz"), xRad, stack[0], stack[1], stack[2], channels, unit)
+    if sectors is not None:
+        writeSectors(roiPath / Path("RadialSectors.npz"), xRad, sectors[0], sectors[1], channels, unit)
+
+
+def writeTableHeader(path):
+    with open(path, "w") as f:
+        print("ROI,RelativeCenterY,RelativeCenterX,AbsoluteCenterY,AbsoluteCenterX,Shape,Z", file=f)
+
+
+def appendTableRow(path, roiName, relativeCenter, absoluteCenter, shape, z):
+    """
+    Appends a single ROI to <scene>_Table.csv, see appendTableRows.
+    """
+    appendTableRows(path, [(roiName, relativeCenter, absoluteCenter, shape, z)])
+
+
+def appendTableRows(path, rows):
+    """
+    Appends (roiName, relativeCenter, absoluteCenter, shape, z) rows to <scene>_Table.csv, opening it once.
+    Centers are (Y, X) but, as in every previous version of the table, are written X first.
+    ROILoader.loadPreviousROIs accounts for this when reloading.
+    """
+    with open(path, "a") as f:
+        for roiName, relativeCenter, absoluteCenter, shape, z in rows:
+            print("{},{},{},{},{},{},{}".format(roiName,
+                                                str(relativeCenter[1]),
+                                                str(relativeCenter[0]),
+                                                str(absoluteCenter[1]),
+                                                str(absoluteCenter[0]),
+                                                str(shape),
+                                                str(z)),
+                  file=f)
+
+
+class HeadlessProfiler:
+    """
+    Runs the radial profile analysis without Napari or Qt, using ROIs and centers that were already defined.
+    Inputs:
+        - image -> A AICSImage instance from the aicsimageio package
+        - scenes -> Friendly scene names to be analyzed
+        - sceneDict -> Mapping of friendly scene names to AICSImage scene names
+        - channels -> A List of channel names for each channel in the image
+        - selectedChannels -> The names of the channels from which intensity values will be taken.
+        - pixelSize, unit -> Scale applied to the distance values
+        - imageOptions -> ProfileOptions.ImageOptions, the projection and the backend of worker processes
+        - backgroundOptions -> ProfileOptions.BackgroundOptions, the background subtraction settings
+        - outputOptions -> ProfileOptions.OutputOptions, the output format and what is written for each ROI
+        - analysisOptions -> ProfileOptions.AnalysisOptions, stack, sector and peak analyses
+        - instrumentationOptions -> ProfileOptions.InstrumentationOptions, timings and cProfile output of each scene
+        - workers -> Number of worker processes ROIs are profiled in (1 runs everything in this process)
+        - imagePath -> Path of the image, needed by worker processes to open their own copy of it
+        - roiGenerator -> Optional AutoROIs.ROIGenerator deriving the ROIs of every scene from a label image or
+          a thresholded channel, used instead of an ROI file or the ROIs of a previous run
+    Options that are not given use the defaults of their class.
+    Progress can be followed by setting progressCallback to a function called with (sceneName, roisDone, roisTotal),
+    and a run can be stopped between ROIs with cancel.
+    """
+
+    def __init__(self, image, scenes, sceneDict, channels, selectedChannels, pixelSize, unit, imageOptions=None, backgroundOptions=None, outputOptions=None, analysisOptions=None, instrumentationOptions=None, workers=1, imagePath=None, roiGenerator=None):
+        self.image = image
+        self.scenes = scenes
+        self.sceneDict = sceneDict
+        self.channels = channels
+        self.selectedChannels = sorted(selectedChannels)
+        # Distances are always written as floats, as by the GUI, even if an int pixel size is given
+        self.pixelSize = float(pixelSize)
+        self.unit = unit
+        self.imageOptions = imageOptions if imageOptions is not None else ProfileOptions.ImageOptions()
+        self.backgroundOptions = backgroundOptions if backgroundOptions is not None else ProfileOptions.BackgroundOptions()
+        self.outputOptions = outputOptions if outputOptions is not None else ProfileOptions.OutputOptions()
+        self.analysisOptions = analysisOptions if analysisOptions is not None else ProfileOptions.AnalysisOptions()
+        self.instrumentationOptions = (instrumentationOptions if instrumentationOptions is not None
+                                       else ProfileOptions.InstrumentationOptions())
+        self.workers = workers
+        self.imagePath = imagePath
+        self.roiGenerator = roiGenerator
+        self.background = Background.BackgroundEstimator(self.backgroundOptions.method, self.backgroundOptions.stdDevs,
+                                                         self.backgroundOptions.step, self.backgroundOptions.sampleSize)
+        self.writer = None
+        self.timings = Instrumentation.Timings()
+        self.cProfile = None
+        self.progressCallback = None
+        self.cancelEvent = threading.Event()
+        self.store = None
+
+    def __getstate__(self):
+        # The image is reopened in each worker process instead of being pickled
+        state = self.__dict__.copy()
+        state["image"] = None
+        state["store"] = None
+        state["writer"] = None
+        state["cProfile"] = None
+        state["progressCallback"] = None
+        state["cancelEvent"] = None
+        return state
+
+    def simplePlot(self, x, y, channels, path):
+        simplePlot(x, y, channels, self.unit, path)
+
+    def checkPath(self, path):
+        return checkPath(path)
+
+    def loadROIs(self, outputPath, sceneName, roiFile):
+        """
+        ROIs come from the ROI generator, the given JSON/GeoJSON file or, if none is given, from a previous run in outputPath.
+        """
+        if self.roiGenerator is not None:
+            return self.roiGenerator.generate(self.sceneReader(self.image), sceneName, self.channels)
+        if roiFile is not None:
+            return ROILoader.loadROIFile(roiFile, sceneName)
+        return ROILoader.loadPreviousROIs(outputPath / sceneName, sceneName)
+
+    def outputWriter(self):
+        """
+        OutputWriter of this process, created on first use (worker processes create their own).
+        """
+        if self.writer is None:
+            self.writer = OutputWriter.OutputWriter(self.outputOptions.writerThreads)
+        return self.writer
+
+    def closeWriter(self):
+        """
+        Waits for the output writer and stops its threads.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def cancel(self):
+        """
+        Stops the run before the next ROI. ROIs profiled so far are written as usual, the other ROIs are only kept
+        in the ROI index (see saveROIs).
+        """
+        self.cancelEvent.set()
+
+    def cancelled(self):
+        return self.cancelEvent is not None and self.cancelEvent.is_set()
+
+    def reportProgress(self, sceneName, done, total):
+        if self.progressCallback is not None:
+            self.progressCallback(sceneName, done, total)
+
+    def beginScene(self, sceneName):
+        """
+        Starts the timers (and the cProfile profiler) of a scene.
+        """
+        options = self.instrumentationOptions
+        self.timings = Instrumentation.Timings(sceneName, options.timings, options.traceMemory)
+        self.cProfile = Instrumentation.startProfile(self.instrumentationOptions.cProfile)
+
+    def endScene(self, scenePath, sceneName):
+        """
+        Writes <scene>_Timings.json and the cProfile dump of a scene into scenePath. If scenePath is None
+        (no ROIs were found) nothing is written.
+        """
+        if scenePath is not None and (self.cProfile is not None or self.instrumentationOptions.timings):
+            checkPath(scenePath)
+        if self.cProfile is not None:
+            if scenePath is not None:
+                Instrumentation.stopProfile(self.cProfile, scenePath / Path(sceneName + "_Profile.prof"))
+            else:
+                self.cProfile.disable()
+            self.cProfile = None
+        if self.instrumentationOptions.timings and scenePath is not None:
+            self.timings.write(scenePath / Path(sceneName + "_Timings.json"), self.workers if self.imagePath is not None else 1)
+
+    def sceneReader(self, image):
+        """
+        Reader for the current scene of image, projecting across Z if a projection is used.
+        """
+        options = self.imageOptions
+        return ImageAccess.SceneReader(image, options.maxIntensity, options.projection, options.zRange, options.threads)
+
+    def stackPlanes(self, reader):
+        """
+        Z-Planes profiled in stack mode
+        """
+        zStart, zStop = (0, reader.nZ) if self.imageOptions.zRange is None else self.imageOptions.zRange
+        return list(range(zStart, zStop))
+
+    def roiZ(self, roi):
+        return None if self.imageOptions.maxIntensity else (roi.z if roi.z is not None else 0)
+
+    def backgroundKey(self, sceneName, channelIndex, z):
+        """
+        Key of a background estimate in self.background.cache
+        """
+        zRange = None if self.imageOptions.zRange is None else tuple(self.imageOptions.zRange)
+        return (sceneName, channelIndex, z, self.imageOptions.maxIntensity, self.imageOptions.projection, zRange)
+
+    def subtractBackground(self, reader, z, scenePath, sceneName, writeImage=True):
+        """
+        Estimates the background of each background channel (by default by fitting a Gaussian to its intensities).
+        The value the specified number of standard deviations above the mean is later subtracted from the ROI
+        crops of that channel. Estimates are cached per scene, channel and Z-Plane.
+        If writeImage is set, the background subtracted plane is written to BackgroundSubtractedImage_Z<z>.tif
+        (BackgroundSubtractedImage.tif for projections, see backgroundImageName).
+        Output: Dictionary mapping channel indices to their background thresholds
+        """
+        thresholds = {}
+        for channel in self.backgroundOptions.channels:
+            channelIndex = self.channels.index(channel)
+            key = self.backgroundKey(sceneName, channelIndex, z)
+            mean, std, backgroundThresh = self.background.estimate(key, lambda: reader.plane([channelIndex], z)[0])
+            thresholds[channelIndex] = backgroundThresh
+
+            with open(scenePath / Path(sceneName + "_Background.csv"), "a") as f:
+                zPlane = self.imageOptions.projection + " projection" if z is None else z
+                print("-", channel, "-Z: ", zPlane, "-Mean: ", mean, "-StdDev: ", std, "-Threshold: ", backgroundThresh,
+                      file=f)
+
+        if not writeImage:
+            return thresholds
+
+        # Written in the dtype of the image, background subtracted values are clipped and cast back to it
+        subtracted_image = None
+        for channelIndex in range(len(self.channels)):
+            img = reader.plane([channelIndex], z)[0]
+            if channelIndex in thresholds:
+                img = subtractThreshold(img, thresholds[channelIndex])
+            if subtracted_image is None:
+                subtracted_image = np.empty(shape=(len(self.channels),) + img.shape, dtype=img.dtype)
+            subtracted_image[channelIndex] = img
+
+        import tifffile
+
+        tifffile.imwrite(scenePath / Path(backgroundImageName(z)), subtracted_image)
+        return thresholds
+
+    def readCrops(self, reader, z, bounds, localMask, thresholds):
+        """
+        Reads the masked bounding box of every selected channel, background subtracting the channels
+        that have a threshold.
+        """
+        channelIndices = [self.channels.index(channel) for channel in self.selectedChannels]
+
+        with self.timings.stage("read"):
+            raw = reader.crop(channelIndices, z, bounds)
+
+        crops = []
+        with self.timings.stage("crop"):
+            for channelIndex, crop in zip(channelIndices, raw):
+                if channelIndex in thresholds:
+                    crop = subtractThreshold(crop, thresholds[channelIndex])
+                crops.append(maskCrop(crop, localMask))
+        return crops
+
+    def readStack(self, reader, zPlanes, bounds, localMask, backgrounds):
+        """
+        Reads the masked bounding box of every selected channel at every timepoint and Z-Plane, background
+        subtracting each Z-Plane of the channels that have a threshold.
+        Output: (T, Z, C, Y, X) array
+        """
+        channelIndices = [self.channels.index(channel) for channel in self.selectedChannels]
+
+        with self.timings.stage("readStack"):
+            stack = reader.stack(channelIndices, bounds, (zPlanes[0], zPlanes[-1] + 1))
+
+        with self.timings.stage("cropStack"):
+            for zIndex, z in enumerate(zPlanes):
+                if self.backgroundOptions.subtract and z not in backgrounds:
+                    raise ValueError("No background fit for Z-Plane " + str(z))
+                thresholds = backgrounds.get(z, {})
+                for cIndex, channelIndex in enumerate(channelIndices):
+                    if channelIndex in thresholds:
+                        stack[:, zIndex, cIndex] = subtractThreshold(stack[:, zIndex, cIndex], thresholds[channelIndex])
+            return maskCrop(stack, localMask)
+
+    def prepareScene(self, reader, rois, scenePath, sceneName):
+        """
+        Writes the headers of the scene's tables and fits the background of every Z-Plane the ROIs use.
+        Only the ROIs that are profiled are given, so planes used only by unchanged ROIs are not fit again.
+        Without any ROIs the background files of a previous run are left untouched.
+        Output: Dictionary mapping Z-Planes to background thresholds (see subtractBackground)
+        """
+        if self.outputOptions.format == "tree":
+            writeTableHeader(scenePath / Path(sceneName + "_Table.csv"))
+
+        backgrounds = {}
+        if not self.backgroundOptions.subtract or len(rois) == 0:
+            return backgrounds
+
+        checkPath(scenePath)
+        with open(scenePath / Path(sceneName + "_Background.csv"), "w") as f:
+            print("Specified Number of Standard Deviations: " + str(self.backgroundOptions.stdDevs), file=f)
+            if self.background.method != "gaussian":
+                print("Background Method: " + self.background.method, file=f)
+            print("Channels Specified:", file =f)
+
+        for z in sorted(set(self.roiZ(roi) for roi in rois), key=str):
+            try:
+                with self.timings.stage("background"):
+                    backgrounds[z] = self.subtractBackground(reader, z, scenePath, sceneName)
+            except Exception as e:
+                print("Background could not be fit for Z-Plane", z)
+                print(e)
+
+        if self.analysisOptions.stack:
+            # Every Z-Plane of the stack gets its own background, fit on single planes even when projecting
+            planeReader = reader.planeReader()
+            for z in self.stackPlanes(reader):
+                if z in backgrounds:
+                    continue
+                try:
+                    with self.timings.stage("background"):
+                        backgrounds[z] = self.subtractBackground(planeReader, z, scenePath, sceneName, writeImage=False)
+                except Exception as e:
+                    print("Background could not be fit for Z-Plane", z)
+                    print(e)
+
+        return backgrounds
+
+    def sceneSettings(self, reader, sceneName):
+        """
+        Hash of every setting that changes the output of an ROI of this scene.
+        """
+        return Manifest.settingsHash({"image": Manifest.imageIdentity(self.imagePath),
+                                      "shape": reader.data.shape,
+                                      "scene": sceneName,
+                                      "channels": self.selectedChannels,
+                                      "pixelSize": self.pixelSize,
+                                      "unit": self.unit,
+                                      "maxIntensity": self.imageOptions.maxIntensity,
+                                      "projection": self.imageOptions.projection,
+                                      "zRange": self.imageOptions.zRange,
+                                      "backgroundSubtract": self.backgroundOptions.subtract,
+                                      "backgroundChannels": self.backgroundOptions.channels,
+                                      "stdDevs": self.backgroundOptions.stdDevs,
+                                      "backgroundMethod": self.background.method,
+                                      "backgroundStep": self.background.step,
+                                      "backgroundSampleSize": self.background.size,
+                                      "stack": self.analysisOptions.stack,
+                                      "tiffCompression": self.outputOptions.tiffCompression,
+                                      "sectors": self.analysisOptions.sectors})
+
+    def expectedFiles(self, roiName):
+        """
+        Files the tree output format writes for an ROI with the current settings.
+        """
+        files = [roiName + "_Coordinates.csv", "Radial.csv"]
+        files += [roiName + "_" + channel + ".tiff" for channel in self.selectedChannels]
+        if self.outputOptions.plots:
+            files.append("RadialPlot.png")
+        if self.analysisOptions.stack:
+            files.append("RadialStack.npz")
+        if self.analysisOptions.sectors > 1:
+            files.append("RadialSectors.npz")
+        return files
+
+    def planScene(self, reader, rois, scenePath, sceneName):
+        """
+        Compares the ROIs with the manifest of the previous run into scenePath. ROIs whose geometry, center, Z-Plane
+        and settings hash are unchanged, and whose output files all exist (see expectedFiles, so e.g. plots skipped
+        by an earlier run are drawn), are not profiled again. The folders of
+        changed and deleted ROIs are removed, and the background estimates of the previous run are reused.
+        Without a manifest every ROI is profiled, and ROI_n folders that are not one of the current ROIs are removed.
+        Output:
+            - Indices of the ROIs to profile
+            - Results of the unchanged ROIs (see profileROIs)
+            - Settings and ROI hashes used by finishScene to write the new manifest, None if not incremental
+        """
+        if not self.outputOptions.incremental or self.outputOptions.format != "tree":
+            return list(range(len(rois))), [], None
+
+        previous = Manifest.loadManifest(scenePath, sceneName)
+        settings = self.sceneSettings(reader, sceneName)
+        hashes = [Manifest.roiHash(roi, settings) for roi in rois]
+        sameSettings = previous["settings"] == settings
+
+        indices, cached = [], []
+        for index, roiHash in enumerate(hashes):
+            roiName = "ROI_" + str(index)
+            entry = previous["rois"].get(roiName) if sameSettings else None
+            if entry is not None and entry["hash"] == roiHash and all((scenePath / roiName / name).exists()
+                                                                     for name in self.expectedFiles(roiName)):
+                cached.append((index, Manifest.rowFromJSON(entry["row"]), None, None))
+            else:
+                indices.append(index)
+        self.timings.count("unchanged", len(cached))
+
+        if sameSettings:
+            for z, channelIndex, mean, std, threshold in previous["backgrounds"]:
+                self.background.cache[self.backgroundKey(sceneName, channelIndex, z)] = (mean, std, threshold)
+
+        unchanged = set("ROI_" + str(result[0]) for result in cached)
+        stale = set(previous["rois"])
+        if previous["settings"] is None:
+            # Without a manifest, ROI folders beyond the current ROIs are left over from an earlier run
+            current = set("ROI_" + str(index) for index in range(len(rois)))
+            stale.update(path.name for path in scenePath.glob("ROI_*")
+                         if path.is_dir() and path.name[4:].isdigit() and path.name not in current)
+        for roiName in stale:
+            if roiName not in unchanged:
+                shutil.rmtree(scenePath / roiName, ignore_errors=True)
+
+        return indices, cached, (settings, hashes)
+
+    def profileROIs(self, reader, rois, indices, backgrounds, scenePath):
+        """
+        Crops, profiles and saves the given ROIs.
+        Input:
+            - reader -> SceneReader of the current scene
+            - rois, indices -> ROIs and their index within the scene
+            - backgrounds -> Output of prepareScene
+            - scenePath -> Folder of the scene
+        Output:
+            - List of (index, tableRow, error, profile) tuples. tableRow is None and error holds the exception
+              message for ROIs that could not be profiled. With the parquet output format nothing is written
+              and profile holds (vertices, xRad, yRPs, counts, stack, sectors) for the ResultsStore. With the tree output
+              format profile is only kept if peaks are searched, otherwise it is None.
+              stack is None, or (zPlanes, profiles, counts) in stack mode.
+              sectors is None, or (profiles, counts) of the (channel, sector, radius) profiles in sector mode.
+        """
+        results = []
+        writer = self.outputWriter()
+        cacheStats = ProfileKernel.indexCache.stats()
+
+        for done, (index, roi) in enumerate(zip(indices, rois)):
+            self.reportProgress(scenePath.name, done, len(rois))
+            if self.cancelled():
+                break
+
+            # ROIs can be drawn incorrectly:
+            #   - Center point outside of image
+            #   - ROI fully outside of image
+            #   - Combinations of both
+            # Use this try, except to ignore incorrect ROIs
+
+            try:
+                # Masks are rasterized one ROI at a time, so an ROI that cannot be rasterized only skips itself
+                with self.timings.stage("masks"):
+                    localMask, (ymin, ymax, xmin, xmax) = ROIMasks.localMask(roi.vertices, roi.shapeType, reader.shape)
+                currZ = self.roiZ(roi)
+                if self.backgroundOptions.subtract and currZ not in backgrounds:
+                    raise ValueError("No background fit for Z-Plane " + str(currZ))
+                thresholds = backgrounds.get(currZ, {})
+
+                oldY, oldX = int(roi.center[0]), int(roi.center[1])
+                newX, newY = int(oldX - xmin), int(oldY - ymin)
+
+                crops = self.readCrops(reader, currZ, (ymin, ymax, xmin, xmax), localMask, thresholds)
+
+                # All channels share the same center and mask, so they are profiled together
+                sectors = None
+                with self.timings.stage("profile"):
+                    if self.analysisOptions.sectors > 1:
+                        yRPs, counts, sectorYRPs, sectorCounts = sectorProfiles(crops, (oldY, oldX),
+                                                                                (ymin, ymax, xmin, xmax),
+                                                                                self.analysisOptions.sectors)
+                        sectors = (sectorYRPs, sectorCounts)
+                    else:
+                        yRPs, counts = radialProfiles(crops, (oldY, oldX), (ymin, ymax, xmin, xmax))
+                self.timings.count("rois")
+                self.timings.count("pixels", localMask.size * len(crops))
+                self.timings.count("radiusBins", len(counts))
+
+                # Adjust x (Distance) values using specified pixel size
+                xRad = np.asarray([ind * self.pixelSize for ind in range(len(yRPs[0]))])
+
+                stack = None
+                if self.analysisOptions.stack:
+                    zPlanes = self.stackPlanes(reader)
+                    stackCrops = self.readStack(reader, zPlanes, (ymin, ymax, xmin, xmax), localMask, backgrounds)
+                    with self.timings.stage("profileStack"):
+                        stackYRPs, stackCounts = stackProfiles(stackCrops, (oldY, oldX), (ymin, ymax, xmin, xmax))
+                    self.timings.count("stackPlanes", stackYRPs.shape[0] * stackYRPs.shape[1])
+                    stack = (zPlanes, stackYRPs, stackCounts)
+
+                row = ("ROI_" + str(index), (newY, newX), (oldY, oldX), roi.shapeType, currZ)
+                profile = (roi.vertices, xRad, yRPs, counts, stack, sectors)
+                if self.outputOptions.format != "tree":
+                    results.append((index, row, None, profile))
+                    continue
+
+                roiName = "ROI_" + str(index)
+                roiPath = scenePath / Path(roiName)
+                checkPath(roiPath)
+
+                # Files are written by the output writer while the next ROIs are profiled, submit only waits
+                # once too many writes are queued
+                with self.timings.stage("writeQueue"):
+                    writer.submit(index, "writeCSV", writeROIFiles, roiPath, roiName, roi.vertices, xRad, yRPs, stack,
+                                  sectors, self.selectedChannels, self.unit)
+                    writer.submit(index, "writeTIFF", writeCrops, roiPath, roiName, self.selectedChannels, crops,
+                                  self.outputOptions.tiffCompression)
+                    if self.outputOptions.plots:
+                        writer.submit(index, "plot", simplePlot, xRad, yRPs, self.selectedChannels, self.unit,
+                                      roiPath / Path("RadialPlot.png"))
+                results.append((index, row, None, profile if self.analysisOptions.peakFinder is not None else None))
+
+            except Exception as e:
+                self.timings.count("skipped")
+                results.append((index, None, str(e), None))
+
+        with self.timings.stage("writeQueue"):
+            failed = writer.flush()
+        summary = writer.summary()
+        if self.timings.enabled:
+            self.timings.merge(summary)
+        if len(failed) != 0:
+            # ROIs whose files could not be written are reported like ROIs that could not be profiled
+            self.timings.count("skipped", len(failed))
+            results = [(result[0], None, failed[result[0]], None) if result[0] in failed else result
+                       for result in results]
+
+        for name, value in ProfileKernel.indexCache.stats().items():
+            if name in ("hits", "misses", "evictions"):
+                self.timings.count("indexCache" + name.capitalize(), value - cacheStats[name])
+
+        if not self.cancelled():
+            self.reportProgress(scenePath.name, len(rois), len(rois))
+        return results
+
+    def finishScene(self, results, scenePath, sceneName, plan=None, rois=None):
+        """
+        Writes the table rows (or the ResultsStore records) of all profiled ROIs in order and reports the ROIs
+        that were skipped. If plan (see planScene) is given, the scene's manifest is written as well.
+        If the scene's ROIs are given, the binary ROI index used to reload them is written next to the table (see saveROIs).
+        """
+        tablePath = scenePath / Path(sceneName + "_Table.csv")
+        tableRows = []
+        for index, row, error, profile in sorted(results, key=lambda result: result[0]):
+            if row is not None and self.outputOptions.format != "tree":
+                with self.timings.stage("writeStore"):
+                    vertices, xRad, yRPs, counts, stack, sectors = profile
+                    self.store.append(sceneName, row, vertices, self.selectedChannels, xRad, yRPs, counts, stack,
+                                      sectors)
+            elif row is not None:
+                tableRows.append(row)
+            else:
+                print()
+                print("ROI_" + str(index), "is not valid.")
+                print(error)
+                print("Skipping. . .")
+                print()
+
+        if len(tableRows) != 0:
+            with self.timings.stage("writeTable"):
+                appendTableRows(tablePath, tableRows)
+
+        if self.outputOptions.format == "tree" and rois is not None:
+            with self.timings.stage("writeIndex"):
+                self.saveROIs(rois, scenePath, sceneName, [result[0] for result in results if result[1] is None])
+
+        if self.analysisOptions.peakFinder is not None:
+            with self.timings.stage("peaks"):
+                self.findPeaks(results, scenePath, sceneName)
+
+        if plan is not None:
+            settings, hashes = plan
+            rois = {row[0]: {"hash": hashes[index], "row": Manifest.tableRow(row)}
+                    for index, row, error, profile in sorted(results, key=lambda result: result[0]) if row is not None}
+            backgrounds = [[key[2], key[1]] + [float(value) for value in estimate]
+                           for key, estimate in self.background.cache.items()
+                           if key[0] == sceneName and key == self.backgroundKey(sceneName, key[1], key[2])]
+            Manifest.writeManifest(scenePath, sceneName, settings, rois, backgrounds)
+
+    def saveROIs(self, rois, scenePath, sceneName, invalid=()):
+        """
+        Writes the binary ROI index used to reload the ROIs of a scene. ROIs that were not profiled because the run
+        was cancelled are kept, so they are profiled when the scene is run again. Only the invalid ROIs (by index)
+        are left out.
+        """
+        invalid = set(invalid)
+        names, indexed = [], []
+        for index, roi in enumerate(rois):
+            if index in invalid:
+                continue
+            names.append("ROI_" + str(index))
+            # Centers and Z-Planes as written to the table, see profileROIs
+            indexed.append(ROILoader.ROI(roi.vertices, roi.shapeType, (int(roi.center[0]), int(roi.center[1])),
+                                         self.roiZ(roi)))
+        ROILoader.writeROIIndex(ROILoader.roiIndexPath(scenePath, sceneName), names, indexed)
+
+    def findPeaks(self, results, scenePath, sceneName):
+        """
+        Searches the peaks of every profiled ROI of a scene at once from the profiles kept in results. Only unchanged
+        ROIs of an incremental run, whose profiles were not computed again, are read from their Radial.csv.
+        Peaks are written to each ROI's Peaks folder and <scene>_PeakInfo.csv, or to the ResultsStore.
+        """
+        roiNames, xs, profiles = [], [], []
+        for index, row, error, profile in sorted(results, key=lambda result: result[0]):
+            if row is None:
+                continue
+            if profile is None:
+                x, y, channels, unit = Plotting.readRadial(scenePath / row[0] / Path("Radial.csv"))
+            else:
+                x, y = profile[1], profile[2]
+            roiNames.append(row[0])
+            xs.append(x)
+            profiles.append(y)
+
+        if self.outputOptions.format == "tree":
+            Peaks.writeScenePeaks(scenePath, sceneName, roiNames, xs, profiles, self.selectedChannels, self.unit,
+                                  self.analysisOptions.peakFinder, self.outputOptions.plots)
+        elif len(roiNames) != 0:
+            found, boundaries = self.analysisOptions.peakFinder.find(xs, profiles)
+            for roiName, peaks in zip(roiNames, found):
+                self.store.appendPeaks(sceneName, int(roiName.split("_")[-1]), self.selectedChannels, peaks)
+
+    def profileScene(self, rois, scenePath, sceneName, reader=None):
+        """
+        Crops, profiles and saves every ROI of the current scene into scenePath.
+        A reader created earlier (see sceneReader) can be given to profile a scene that is no longer current.
+        """
+        if self.timings.scene != sceneName:
+            self.beginScene(sceneName)
+        if reader is None:
+            reader = self.sceneReader(self.image)
+        indices, cached, plan = self.planScene(reader, rois, scenePath, sceneName)
+        backgrounds = self.prepareScene(reader, [rois[i] for i in indices], scenePath, sceneName)
+        results = self.profileROIs(reader, [rois[i] for i in indices], indices, backgrounds, scenePath)
+        self.finishScene(cached + results, scenePath, sceneName, plan, rois)
+        self.endScene(scenePath, sceneName)
+
+    def executeScript(self, outputPath, roiFile=None):
+        """
+        Executes the radial profile analysis for every scene without opening a viewer.
+
+        Input:
+            - outputPath: Output directory, laid out exactly as by RadialProfiler.executeScript
+                          (or holding a ResultsStore with the parquet output format)
+            - roiFile: Optional JSON/GeoJSON ROI file. If not given, ROIs of a previous run in outputPath are used.
+        """
+        outputPath = Path(outputPath)
+        checkPath(outputPath)
+
+        if self.outputOptions.format != "tree":
+            self.store = ResultsStore.ResultsStore(outputPath, self.unit, self.pixelSize)
+        try:
+            if self.workers > 1 and self.imagePath is not None:
+                self.executeParallel(outputPath, roiFile)
+            else:
+                self.executeSerial(outputPath, roiFile)
+        finally:
+            self.closeWriter()
+            if self.store is not None:
+                self.store.close()
+                self.store = None
+
+    def executeSerial(self, outputPath, roiFile=None):
+        """
+        Profiles every scene in this process.
+        """
+        for scene in self.scenes:
+            if self.cancelled():
+                break
+            origScene = self.sceneDict[scene]
+            self.image.set_scene(self.image.scenes.index(origScene))
+            sceneName = folderName(scene)
+            self.beginScene(sceneName)
+
+            try:
+                with self.timings.stage("loadROIs"):
+                    rois = self.loadROIs(outputPath, sceneName, roiFile)
+            except Exception as e:
+                print("No ROIs Found For", scene)
+                print(e)
+                self.endScene(None, sceneName)
+                continue
+
+            # With the parquet output format the scene folder is only created if a background or timings file is written
+            scenePath = outputPath / sceneName
+            if self.outputOptions.format == "tree":
+                checkPath(scenePath)
+            self.profileScene(rois, scenePath, sceneName)
+
+    def executeParallel(self, outputPath, roiFile=None):
+        """
+        Same as executeScript, but ROIs of every scene are split into chunks that are profiled and saved by a
+        pool of worker processes. Each worker opens the image itself and reads only its own crops. Table rows
+        are written in ROI order once a scene's chunks are done, so the output is identical to a serial run.
+        """
+        # Workers are spawned rather than forked, forking after dask has started its threads can deadlock
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=initWorker, initargs=(str(self.imagePath), self.imageOptions.backend)) as pool:
+            pending = []
+            for scene in self.scenes:
+                if self.cancelled():
+                    break
+                origScene = self.sceneDict[scene]
+                sceneIndex = self.image.scenes.index(origScene)
+                self.image.set_scene(sceneIndex)
+                sceneName = folderName(scene)
+                self.beginScene(sceneName)
+
+                try:
+                    with self.timings.stage("loadROIs"):
+                        rois = self.loadROIs(outputPath, sceneName, roiFile)
+                except Exception as e:
+                    print("No ROIs Found For", scene)
+                    print(e)
+                    self.endScene(None, sceneName)
+                    continue
+
+                scenePath = outputPath / sceneName
+                if self.outputOptions.format == "tree":
+                    checkPath(scenePath)
+                reader = self.sceneReader(self.image)
+                indices, cached, plan = self.planScene(reader, rois, scenePath, sceneName)
+                backgrounds = self.prepareScene(reader, [rois[i] for i in indices], scenePath, sceneName)
+
+                # A few chunks per worker keeps every worker busy without sending one task per ROI
+                chunkSize = max(1, -(-len(indices) // (self.workers * 4)))
+                futures = []
+                for start in range(0, len(indices), chunkSize):
+                    chunk = indices[start:start + chunkSize]
+                    futures.append(pool.submit(profileChunk, self, sceneIndex, [rois[i] for i in chunk],
+                                               chunk, backgrounds, scenePath))
+                # Scenes are finished once all of them are submitted, the profiler is resumed then
+                if self.cProfile is not None:
+                    self.cProfile.disable()
+                pending.append((scenePath, sceneName, rois, futures, cached, plan, self.timings, self.cProfile))
+
+            for scenePath, sceneName, rois, futures, cached, plan, timings, profile in pending:
+                self.timings, self.cProfile = timings, profile
+                if self.cProfile is not None:
+                    self.cProfile.enable()
+                results = list(cached)
+                for future in futures:
+                    chunkResults, summary = future.result()
+                    results.extend(chunkResults)
+                    self.timings.merge(summary)
+                self.finishScene(results, scenePath, sceneName, plan, rois)
+                self.endScene(scenePath, sceneName)
+
+
+# Path and backend of the image each worker process of HeadlessProfiler.executeParallel opens
+workerImage = None
+
+
+def initWorker(imagePath, imageBackend="auto"):
+    global workerImage
+    workerImage = (imagePath, imageBackend)
+
+
+def profileChunk(profiler, sceneIndex, rois, indices, backgrounds, scenePath):
+    """
+    Worker process entry point: profiles a chunk of ROIs of one scene using the worker's own image, which is
+    opened for the chunk and closed again once its ROIs are profiled.
+    Output: Results of profileROIs and the timings of the chunk (see Instrumentation.Timings.summary)
+    """
+    image = ImageAccess.openImage(*workerImage)
+    try:
+        profiler.image = image
+        options = profiler.instrumentationOptions
+        profiler.timings = Instrumentation.Timings(profiler.timings.scene, options.timings, options.traceMemory)
+        image.set_scene(sceneIndex)
+        reader = profiler.sceneReader(image)
+        results = profiler.profileROIs(reader, rois, indices, backgrounds, scenePath)
+        profiler.closeWriter()
+    finally:
+        ImageAccess.closeImage(image)
+    return results, profiler.timings.summary()
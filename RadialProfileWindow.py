@@ -1,11 +1,14 @@
 import sys
-from PyQt5.QtWidgets import QMainWindow, QFileDialog, QApplication
+from PyQt5.QtWidgets import QMainWindow, QFileDialog, QApplication, QProgressBar, QPushButton
 from PyQt5.uic import loadUi
 
-from aicsimageio import AICSImage
 from pathlib import Path
 
+import ImageAccess
+import ProfileOptions
+import ProfileWorker
 import RadialProfile as rp
+import RadialProfileEngine as rpe
 
 class MainWindow(QMainWindow):
     """
@@ -22,8 +25,11 @@ class MainWindow(QMainWindow):
 
         # Create RadialProfile Instance Once Able to
         self.rp = None
+        # Thread profiling the scenes while the next ones are drawn
+        self.worker = None
         # Attributes needed to instantiate RadialProfile instance.
         self.image = None
+        self.imagePath = None
         self.scenes = None
         self.sceneDict = None
         self.channels = None
@@ -55,13 +61,35 @@ class MainWindow(QMainWindow):
         self.backgroundSubtract.stateChanged.connect(self.doBackgroundSubtraction)
         self.runButton.clicked.connect(self.createRadialProfile)
 
+        # Progress of the analysis, shown in the status bar while a run is in progress
+        self.progressBar = QProgressBar()
+        self.progressBar.setVisible(False)
+        self.cancelButton = QPushButton("Cancel")
+        self.cancelButton.setVisible(False)
+        self.cancelButton.clicked.connect(self.cancelRun)
+        self.statusbar.addPermanentWidget(self.progressBar)
+        self.statusbar.addPermanentWidget(self.cancelButton)
+
     def openFile(self, fpath):
         """
         Opens the file path specified by the user
         """
 
         path = Path(fpath)
-        self.image = AICSImage(path)
+        image = ImageAccess.openImage(path)
+        # The previous image is only closed once the new one opened, so a failed open keeps it usable.
+        # An image a run is still profiling is closed by runFinished instead.
+        if self.image is not None and (self.rp is None or self.rp.image is not self.image):
+            ImageAccess.closeImage(self.image)
+        self.image = image
+        self.imagePath = path
+        self.populateForm(path)
+
+    def populateForm(self, path):
+        """
+        Fills the scene and channel lists and the pixel size of the opened image. No pixels are read.
+        """
+        self.image.set_scene(0)
         self.sampleList.clear()
 
         xScale = self.image.physical_pixel_sizes[2]
@@ -76,24 +104,17 @@ class MainWindow(QMainWindow):
 
         self.unit = self.unitLabel.text()
 
-        if path.suffix != ".lif":
-            sceneNames = [str(path.name).split(".")[0] + "_" + str(index) for index in range(len(self.image.scenes))]
-            self.sceneDict = {sceneName:scene for sceneName,scene in zip(sceneNames, self.image.scenes)}
-            self.scenes = list(self.sceneDict.keys())
-            self.sampleList.addItems(list(self.sceneDict.keys()))
-
-        else:
-            self.sceneDict = {scene:scene for scene in self.image.scenes}
-            self.scenes = list(self.sceneDict.keys())
-            self.sampleList.addItems(list(self.sceneDict.keys()))
+        self.sceneDict = rpe.buildSceneDict(path, self.image)
+        self.scenes = list(self.sceneDict.keys())
+        self.sampleList.addItems(list(self.sceneDict.keys()))
 
 
-        # Assumes each sample has the same number of channels
-        nChannels = self.image.data.shape[1]
+        # Assumes each sample has the same number of channels. Read from the metadata, no pixels are loaded.
+        nChannels = self.image.dims.C
         self.channels = []
         self.channelList.clear()
         self.backSubChannels.clear()
-        self.channels = ["Channel_" + str(num+1) for num in range(nChannels)]
+        self.channels = rpe.channelNames(nChannels)
         self.channelList.addItems(self.channels)
         self.backSubChannels.addItems(self.channels)
 
@@ -178,6 +199,10 @@ class MainWindow(QMainWindow):
             self.sceneDict is not None and self.pixelSize is not None 
             and self.unit is not None and len(self.selectedChannels) != 0):
 
+            if self.rp is not None:
+                # The previous run is still being profiled
+                return
+
             self.rp = rp.RadialProfiler(self.image, 
                                         self.scenes, 
                                         self.sceneDict, 
@@ -186,17 +211,68 @@ class MainWindow(QMainWindow):
                                         self.pixelSize, 
                                         self.unit,
                                         self.reload,
-                                        self.maxIntensity,
-                                        self.doBackgroundSubtract,
-                                        self.backgroundChannels,
-                                        self.numStdDevs)
-            self.rp.executeScript(Path(self.outputLine.text()))
-            self.rp = None
-            self.openFile(self.inputLine.text())
+                                        imageOptions=ProfileOptions.ImageOptions(maxIntensity=self.maxIntensity),
+                                        backgroundOptions=ProfileOptions.BackgroundOptions(subtract=self.doBackgroundSubtract,
+                                                                                           channels=self.backgroundChannels,
+                                                                                           stdDevs=self.numStdDevs),
+                                        imagePath=self.imagePath)
+
+            # Scenes are profiled by the worker thread as soon as their viewer is closed
+            self.worker = ProfileWorker.ProfileWorker(self.rp, self)
+            self.worker.progress.connect(self.showProgress)
+            self.worker.sceneDone.connect(self.sceneDone)
+            self.worker.finished.connect(self.runFinished)
+
+            self.runButton.setEnabled(False)
+            self.progressBar.setRange(0, 1)
+            self.progressBar.setValue(0)
+            self.progressBar.setFormat("Waiting for ROIs")
+            self.progressBar.setVisible(True)
+            self.cancelButton.setVisible(True)
+            self.worker.start()
+
+            # Napari Viewers must run on this thread, the worker stops once all of them are closed and their scenes are profiled
+            try:
+                self.rp.executeScript(Path(self.outputLine.text()))
+            finally:
+                self.worker.queue.put(None)
 
         else:
             pass
 
+    def showProgress(self, sceneName, done, total):
+        self.progressBar.setRange(0, max(total, 1))
+        self.progressBar.setValue(done)
+        self.progressBar.setFormat(sceneName + ": ROI " + str(done) + " / " + str(total))
+
+    def sceneDone(self, sceneName, scenesDone):
+        self.statusbar.showMessage(sceneName + " done (" + str(scenesDone) + " / " + str(len(self.rp.scenes)) + " scenes)")
+
+    def cancelRun(self):
+        """
+        Stops the run before the next ROI. No further viewers are opened.
+        ROIs that were drawn but not profiled are saved, and are only profiled once their scene is run again with
+        Reload ROIs checked.
+        """
+        if self.rp is not None:
+            self.rp.cancel()
+            self.progressBar.setFormat("Cancelling. . .")
+            self.statusbar.showMessage("Unprofiled ROIs are saved, run again with Reload ROIs to profile them")
+
+    def runFinished(self):
+        """
+        Resets the window once the worker has profiled every scene (or was cancelled).
+        """
+        self.statusbar.showMessage("Run cancelled, run again with Reload ROIs to profile the remaining ROIs" if self.rp.cancelled() else "Run finished")
+        if self.rp.image is not self.image:
+            ImageAccess.closeImage(self.rp.image)
+        self.rp = None
+        self.worker = None
+        self.progressBar.setVisible(False)
+        self.cancelButton.setVisible(False)
+        self.runButton.setEnabled(True)
+        self.populateForm(Path(self.inputLine.text()))
+
     def setPixelSize(self):
         self.pixelSize = self.xyScale.value()
 
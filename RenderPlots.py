@@ -0,0 +1,18 @@
+import argparse
+
+import Plotting
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Draw the plots of a finished run from its Radial.csv files or Profiles.parquet.")
+    parser.add_argument("output", help="Output directory of a run")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes plots are drawn in")
+    parser.add_argument("--no-roi-plots", action="store_true", help="Do not draw RadialPlot.png for every ROI")
+    parser.add_argument("--no-summary", action="store_true", help="Do not draw a summary plot of all ROIs of each scene")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    Plotting.renderPlots(args.output, args.workers, roiPlots=not args.no_roi_plots, summary=not args.no_summary)
+
+if __name__=="__main__":
+    main()
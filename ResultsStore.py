@@ -0,0 +1,467 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+import ProfileKernel
+import ROILoader
+
+# pyarrow is only imported once the parquet output format is used, see requirePyarrow
+pa = None
+pq = None
+
+
+PROFILES_FILE = "Profiles.parquet"
+ROIS_FILE = "ROIs.parquet"
+STACKS_FILE = "StackProfiles.parquet"
+PEAKS_FILE = "Peaks.parquet"
+SECTORS_FILE = "SectorProfiles.parquet"
+
+# Every file a ResultsStore writes, removed when a new store is opened in the same directory
+STORE_FILES = (PROFILES_FILE, ROIS_FILE, STACKS_FILE, PEAKS_FILE, SECTORS_FILE)
+
+# Number of profile rows buffered in memory before they are written as one Parquet row group
+BATCH_ROWS = 1 << 16
+
+
+def requirePyarrow():
+    global pa, pq
+    if pa is not None:
+        return
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is required for the parquet output format (pip install pyarrow)")
+    pa, pq = pyarrow, pyarrow.parquet
+
+
+def profileSchema():
+    return pa.schema([("scene", pa.string()),
+                      ("roi", pa.int32()),
+                      ("channel", pa.string()),
+                      ("radius", pa.float64()),
+                      ("mean", pa.float64()),
+                      ("count", pa.int64())])
+
+
+def stackSchema():
+    return pa.schema([("scene", pa.string()),
+                      ("roi", pa.int32()),
+                      ("t", pa.int32()),
+                      ("z", pa.int32()),
+                      ("channel", pa.string()),
+                      ("radius", pa.float64()),
+                      ("mean", pa.float64()),
+                      ("count", pa.int64())])
+
+
+def sectorSchema():
+    return pa.schema([("scene", pa.string()),
+                      ("roi", pa.int32()),
+                      ("channel", pa.string()),
+                      ("sector", pa.int32()),
+                      ("angle", pa.float64()),
+                      ("radius", pa.float64()),
+                      ("mean", pa.float64()),
+                      ("count", pa.int64())])
+
+
+def peakSchema():
+    return pa.schema([("scene", pa.string()),
+                      ("roi", pa.int32()),
+                      ("channel", pa.string()),
+                      ("position", pa.float64()),
+                      ("relativePosition", pa.float64()),
+                      ("height", pa.float64())])
+
+
+def peakColumns(sceneName, roi, channels, peaks):
+    """
+    Peak rows of one ROI, one per channel and peak.
+    Input: peaks -> One (positions, relativePositions, heights) tuple per channel, see Peaks.PeakFinder.find
+    """
+    counts = [len(positions) for positions, relativePositions, heights in peaks]
+    return {"scene": np.full(sum(counts), sceneName, dtype=object),
+            "roi": np.full(sum(counts), roi, dtype=np.int32),
+            "channel": np.repeat(np.asarray(channels, dtype=object), counts),
+            "position": np.concatenate([np.asarray(peak[0], dtype=np.float64) for peak in peaks]),
+            "relativePosition": np.concatenate([np.asarray(peak[1], dtype=np.float64) for peak in peaks]),
+            "height": np.concatenate([np.asarray(peak[2], dtype=np.float64) for peak in peaks])}
+
+
+def writePeaks(storePath, columns):
+    """
+    Writes Peaks.parquet from a list of peakColumns, replacing any previous peaks of the store.
+    """
+    requirePyarrow()
+    table = pa.table({name: np.concatenate([column[name] for column in columns]) if len(columns) else []
+                      for name in peakSchema().names}, schema=peakSchema())
+    pq.write_table(table, Path(storePath) / PEAKS_FILE)
+
+
+def roiSchema():
+    return pa.schema([("scene", pa.string()),
+                      ("roi", pa.int32()),
+                      ("relativeCenterY", pa.int64()),
+                      ("relativeCenterX", pa.int64()),
+                      ("absoluteCenterY", pa.int64()),
+                      ("absoluteCenterX", pa.int64()),
+                      ("shape", pa.string()),
+                      ("z", pa.int64()),
+                      ("verticesY", pa.list_(pa.float64())),
+                      ("verticesX", pa.list_(pa.float64()))])
+
+
+class ResultsStore:
+    """
+    Consolidated output of a run: two Parquet files in the output directory instead of a folder per ROI.
+        - Profiles.parquet -> Long format profiles, one row per scene, ROI, channel and radius
+                              with the mean intensity and the number of pixels at that radius
+        - ROIs.parquet -> The rows of every scene's _Table.csv together with the ROI vertices
+        - Peaks.parquet -> Only if peaks are searched, position, position relative to the reference channel's
+                           boundary and height of every peak, one row per scene, ROI, channel and peak
+        - StackProfiles.parquet -> Only in stack mode, long format profiles of every timepoint and Z-Plane,
+                                   one row per scene, ROI, t, z, channel and radius
+        - SectorProfiles.parquet -> Only in sector mode, long format profiles of every angular sector, one row per
+                                    scene, ROI, channel, sector (with the angle it starts at) and radius
+    Rows are buffered and written in batches of batchRows as Parquet row groups.
+    The files of a previous store in outputPath are removed when the store is opened, so files of options the new
+    run does not use (e.g. StackProfiles.parquet without stack mode) are not read or exported with its results.
+    The folder layout of a normal run can be recreated with exportTree.
+    Inputs:
+        - outputPath -> Output directory of the run
+        - unit, pixelSize -> Stored in the file metadata so the export can write the Radial.csv header
+        - batchRows -> Number of profile rows buffered before a batch is written
+    """
+
+    def __init__(self, outputPath, unit, pixelSize, batchRows=BATCH_ROWS):
+        requirePyarrow()
+        self.outputPath = Path(outputPath)
+        self.metadata = {b"radialProfile": json.dumps({"unit": unit, "pixelSize": pixelSize}).encode()}
+        self.batchRows = batchRows
+        self.profileWriter = None
+        self.roiWriter = None
+        self.stackWriter = None
+        self.sectorWriter = None
+        self.peakWriter = None
+        self.clearBuffers()
+        for name in STORE_FILES:
+            (self.outputPath / name).unlink(missing_ok=True)
+
+    def clearBuffers(self):
+        self.profiles = {name: [] for name in profileSchema().names}
+        self.rois = {name: [] for name in roiSchema().names}
+        self.stacks = {name: [] for name in stackSchema().names}
+        self.sectors = {name: [] for name in sectorSchema().names}
+        self.peaks = {name: [] for name in peakSchema().names}
+        self.bufferedRows = 0
+
+    def append(self, sceneName, row, vertices, channels, xRad, yRPs, counts, stack=None, sectors=None):
+        """
+        Adds one profiled ROI.
+        Input:
+            - sceneName -> Scene folder name
+            - row -> (roiName, relativeCenter, absoluteCenter, shape, z) as written by appendTableRow
+            - vertices -> (N, 2) array of (Y, X) vertices of the ROI
+            - channels -> Names of the profiled channels
+            - xRad -> Distance of each radius bin
+            - yRPs -> Mean intensities, one array per channel
+            - counts -> Number of pixels in each radius bin
+            - stack -> Optional (zPlanes, profiles, counts) of stack mode, profiles being a (T, Z, channel, radius) array
+            - sectors -> Optional (profiles, counts) of sector mode, profiles being a (channel, sector, radius) array
+        """
+        roiName, relativeCenter, absoluteCenter, shape, z = row
+        roi = int(roiName.split("_")[-1])
+        nBins = len(xRad)
+        nRows = nBins * len(channels)
+
+        self.profiles["scene"].append(np.full(nRows, sceneName, dtype=object))
+        self.profiles["roi"].append(np.full(nRows, roi, dtype=np.int32))
+        self.profiles["channel"].append(np.repeat(np.asarray(channels, dtype=object), nBins))
+        self.profiles["radius"].append(np.tile(np.asarray(xRad, dtype=np.float64), len(channels)))
+        self.profiles["mean"].append(np.concatenate([np.asarray(yRP, dtype=np.float64) for yRP in yRPs]))
+        self.profiles["count"].append(np.tile(np.asarray(counts, dtype=np.int64), len(channels)))
+
+        vertices = np.asarray(vertices, dtype=np.float64)
+        for name, value in zip(roiSchema().names, (sceneName, roi, relativeCenter[0], relativeCenter[1],
+                                                   absoluteCenter[0], absoluteCenter[1], str(shape), z,
+                                                   vertices[:, 0], vertices[:, 1])):
+            self.rois[name].append(value)
+
+        if stack is not None:
+            nRows += self.appendStack(sceneName, roi, channels, xRad, *stack)
+        if sectors is not None:
+            nRows += self.appendSectors(sceneName, roi, channels, xRad, *sectors)
+
+        self.bufferedRows += nRows
+        if self.bufferedRows >= self.batchRows:
+            self.flush()
+
+    def appendStack(self, sceneName, roi, channels, xRad, zPlanes, profiles, counts):
+        """
+        Adds the (T, Z, channel, radius) profiles of one ROI in stack mode.
+        Output: Number of rows added
+        """
+        nT, nZ, nC, nBins = profiles.shape
+        nRows = profiles.size
+
+        self.stacks["scene"].append(np.full(nRows, sceneName, dtype=object))
+        self.stacks["roi"].append(np.full(nRows, roi, dtype=np.int32))
+        self.stacks["t"].append(np.repeat(np.arange(nT, dtype=np.int32), nZ * nC * nBins))
+        self.stacks["z"].append(np.tile(np.repeat(np.asarray(zPlanes, dtype=np.int32), nC * nBins), nT))
+        self.stacks["channel"].append(np.tile(np.repeat(np.asarray(channels, dtype=object), nBins), nT * nZ))
+        self.stacks["radius"].append(np.tile(np.asarray(xRad, dtype=np.float64), nT * nZ * nC))
+        self.stacks["mean"].append(profiles.astype(np.float64).ravel())
+        self.stacks["count"].append(np.tile(np.asarray(counts, dtype=np.int64), nT * nZ * nC))
+        return nRows
+
+    def appendSectors(self, sceneName, roi, channels, xRad, profiles, counts):
+        """
+        Adds the (channel, sector, radius) profiles of one ROI in sector mode.
+        Output: Number of rows added
+        """
+        nC, nSectors, nBins = profiles.shape
+        nRows = profiles.size
+
+        self.sectors["scene"].append(np.full(nRows, sceneName, dtype=object))
+        self.sectors["roi"].append(np.full(nRows, roi, dtype=np.int32))
+        self.sectors["channel"].append(np.repeat(np.asarray(channels, dtype=object), nSectors * nBins))
+        self.sectors["sector"].append(np.tile(np.repeat(np.arange(nSectors, dtype=np.int32), nBins), nC))
+        self.sectors["angle"].append(np.tile(np.repeat(ProfileKernel.sectorAngles(nSectors), nBins), nC))
+        self.sectors["radius"].append(np.tile(np.asarray(xRad, dtype=np.float64), nC * nSectors))
+        self.sectors["mean"].append(profiles.astype(np.float64).ravel())
+        self.sectors["count"].append(np.tile(np.asarray(counts, dtype=np.int64).ravel(), nC))
+        return nRows
+
+    def appendPeaks(self, sceneName, roi, channels, peaks):
+        """
+        Adds the peaks of one ROI, see peakColumns.
+        """
+        for name, values in peakColumns(sceneName, roi, channels, peaks).items():
+            self.peaks[name].append(values)
+
+    def flush(self):
+        """
+        Writes the buffered rows as one row group of each file.
+        """
+        self.flushPeaks()
+        if len(self.rois["roi"]) == 0:
+            return
+
+        profileTable = pa.table({name: np.concatenate(columns) for name, columns in self.profiles.items()},
+                                schema=profileSchema())
+        roiTable = pa.table({name: columns for name, columns in self.rois.items()}, schema=roiSchema())
+
+        if self.profileWriter is None:
+            self.profileWriter = pq.ParquetWriter(self.outputPath / PROFILES_FILE,
+                                                  profileSchema().with_metadata(self.metadata))
+            self.roiWriter = pq.ParquetWriter(self.outputPath / ROIS_FILE, roiSchema().with_metadata(self.metadata))
+        self.profileWriter.write_table(profileTable)
+        self.roiWriter.write_table(roiTable)
+
+        if len(self.stacks["roi"]) != 0:
+            stackTable = pa.table({name: np.concatenate(columns) for name, columns in self.stacks.items()},
+                                  schema=stackSchema())
+            if self.stackWriter is None:
+                self.stackWriter = pq.ParquetWriter(self.outputPath / STACKS_FILE,
+                                                    stackSchema().with_metadata(self.metadata))
+            self.stackWriter.write_table(stackTable)
+
+        if len(self.sectors["roi"]) != 0:
+            sectorTable = pa.table({name: np.concatenate(columns) for name, columns in self.sectors.items()},
+                                   schema=sectorSchema())
+            if self.sectorWriter is None:
+                self.sectorWriter = pq.ParquetWriter(self.outputPath / SECTORS_FILE,
+                                                     sectorSchema().with_metadata(self.metadata))
+            self.sectorWriter.write_table(sectorTable)
+        self.clearBuffers()
+
+    def flushPeaks(self):
+        if len(self.peaks["roi"]) == 0:
+            return
+        peakTable = pa.table({name: np.concatenate(columns) for name, columns in self.peaks.items()}, schema=peakSchema())
+        if self.peakWriter is None:
+            self.peakWriter = pq.ParquetWriter(self.outputPath / PEAKS_FILE, peakSchema().with_metadata(self.metadata))
+        self.peakWriter.write_table(peakTable)
+        self.peaks = {name: [] for name in peakSchema().names}
+
+    def close(self):
+        self.flush()
+        if self.profileWriter is not None:
+            self.profileWriter.close()
+            self.roiWriter.close()
+            self.profileWriter = None
+            self.roiWriter = None
+        if self.stackWriter is not None:
+            self.stackWriter.close()
+            self.stackWriter = None
+        if self.sectorWriter is not None:
+            self.sectorWriter.close()
+            self.sectorWriter = None
+        if self.peakWriter is not None:
+            self.peakWriter.close()
+            self.peakWriter = None
+
+
+def readStore(storePath):
+    """
+    Reads the consolidated results of a run.
+    Output:
+        - Profiles as a pandas DataFrame
+        - ROI table as a pandas DataFrame
+        - Metadata dictionary (unit and pixelSize)
+    """
+    requirePyarrow()
+    storePath = Path(storePath)
+    profiles = pq.read_table(storePath / PROFILES_FILE)
+    rois = pq.read_table(storePath / ROIS_FILE)
+    metadata = json.loads(profiles.schema.metadata[b"radialProfile"])
+    return profiles.to_pandas(), rois.to_pandas(), metadata
+
+
+def readStacks(storePath):
+    """
+    Reads the stack mode profiles of a run.
+    Output: Dictionary mapping (scene, roi) to a tuple of
+        - Distance of each radius
+        - Z-Plane of each Z index
+        - Channel names
+        - (T, Z, channel, radius) array of mean intensities
+        - Number of pixels at each radius
+    """
+    requirePyarrow()
+    stacks = pq.read_table(Path(storePath) / STACKS_FILE).to_pandas()
+    output = {}
+    for (sceneName, roi), stack in stacks.groupby(["scene", "roi"], sort=False):
+        zPlanes = list(dict.fromkeys(stack["z"]))
+        channels = list(dict.fromkeys(stack["channel"]))
+        nT = stack["t"].nunique()
+        nBins = len(stack) // (nT * len(zPlanes) * len(channels))
+        profiles = stack["mean"].to_numpy().reshape(nT, len(zPlanes), len(channels), nBins)
+        output[(sceneName, roi)] = (stack["radius"].to_numpy()[:nBins], np.asarray(zPlanes), channels, profiles,
+                                    stack["count"].to_numpy()[:nBins])
+    return output
+
+
+def readSectors(storePath):
+    """
+    Reads the sector mode profiles of a run.
+    Output: Dictionary mapping (scene, roi) to a tuple of
+        - Distance of each radius
+        - Channel names
+        - (channel, sector, radius) array of mean intensities
+        - (sector, radius) array of the number of pixels in each bin
+    """
+    requirePyarrow()
+    sectors = pq.read_table(Path(storePath) / SECTORS_FILE).to_pandas()
+    output = {}
+    for (sceneName, roi), sector in sectors.groupby(["scene", "roi"], sort=False):
+        channels = list(dict.fromkeys(sector["channel"]))
+        nSectors = sector["sector"].nunique()
+        nBins = len(sector) // (nSectors * len(channels))
+        profiles = sector["mean"].to_numpy().reshape(len(channels), nSectors, nBins)
+        output[(sceneName, roi)] = (sector["radius"].to_numpy()[:nBins], channels, profiles,
+                                    sector["count"].to_numpy()[:nSectors * nBins].reshape(nSectors, nBins))
+    return output
+
+
+def readPeaks(storePath):
+    """
+    Reads the peaks of a run.
+    Output: Dictionary mapping (scene, roi) to a dictionary mapping each channel with peaks to its
+            (positions, relativePositions, heights), see Peaks.PeakFinder.find
+    """
+    requirePyarrow()
+    peaks = pq.read_table(Path(storePath) / PEAKS_FILE).to_pandas()
+    output = {}
+    for (sceneName, roi, channel), peak in peaks.groupby(["scene", "roi", "channel"], sort=False):
+        output.setdefault((sceneName, roi), {})[channel] = (peak["position"].to_numpy(),
+                                                            peak["relativePosition"].to_numpy(),
+                                                            peak["height"].to_numpy())
+    return output
+
+
+def exportTree(storePath, outputPath=None, plots=True):
+    """
+    Recreates the folder layout of a normal run from a ResultsStore: a folder per scene with its _Table.csv
+    and binary ROI index, and a folder per ROI with ROI_n_Coordinates.csv, Radial.csv and RadialPlot.png (and RadialStack.npz
+    in stack mode, RadialSectors.npz in sector mode). If the store holds Peaks.parquet, every ROI also gets its Peaks
+    folder of peak tables and every scene its _PeakInfo.csv.
+    The cropped ROI TIFFs hold image data and are not part of the store, run with the tree output format to get them.
+    Peak plots (drawn from the searched part of each profile) and the _Manifest.json of incremental runs are not
+    written either. Run FindPeaks.py on the exported tree for the plots; a later run into the exported tree
+    profiles every ROI again, since there is no manifest to compare against.
+    Input:
+        - storePath -> Output directory holding Profiles.parquet and ROIs.parquet
+        - outputPath -> Directory the tree is written to (default: storePath)
+        - plots -> Also draw RadialPlot.png for every ROI
+    """
+    # Imported here, RadialProfileEngine imports this module
+    import Peaks
+    import RadialProfileEngine as rpe
+
+    outputPath = Path(storePath if outputPath is None else outputPath)
+    profiles, rois, metadata = readStore(storePath)
+    unit = metadata["unit"]
+    stacks = readStacks(storePath) if (Path(storePath) / STACKS_FILE).exists() else {}
+    sectors = readSectors(storePath) if (Path(storePath) / SECTORS_FILE).exists() else {}
+    peaks = readPeaks(storePath) if (Path(storePath) / PEAKS_FILE).exists() else None
+
+    groups = profiles.groupby(["scene", "roi"], sort=False)
+    for sceneName, sceneROIs in rois.groupby("scene", sort=False):
+        scenePath = outputPath / sceneName
+        rpe.checkPath(scenePath)
+        tablePath = scenePath / Path(sceneName + "_Table.csv")
+        rpe.writeTableHeader(tablePath)
+        names, indexed, rows, peakRows = [], [], [], []
+
+        for roi in sceneROIs.itertuples(index=False):
+            roiName = "ROI_" + str(roi.roi)
+            z = None if roi.z is None or np.isnan(roi.z) else int(roi.z)
+            rows.append((roiName, (roi.relativeCenterY, roi.relativeCenterX),
+                         (roi.absoluteCenterY, roi.absoluteCenterX), roi.shape, z))
+
+            roiPath = scenePath / Path(roiName)
+            rpe.checkPath(roiPath)
+            vertices = np.column_stack([roi.verticesY, roi.verticesX])
+            np.savetxt(roiPath / Path(roiName + "_Coordinates.csv"), vertices, delimiter=",")
+            names.append(roiName)
+            indexed.append(ROILoader.ROI(vertices, roi.shape, (roi.absoluteCenterY, roi.absoluteCenterX), z))
+
+            profile = groups.get_group((sceneName, roi.roi))
+            channels = list(dict.fromkeys(profile["channel"]))
+            nBins = len(profile) // len(channels)
+            xRad = profile["radius"].to_numpy()[:nBins]
+            yRPs = list(profile["mean"].to_numpy().reshape(len(channels), nBins))
+
+            rpe.writeRadial(roiPath / Path("Radial.csv"), xRad, yRPs, channels, unit)
+            if (sceneName, roi.roi) in stacks:
+                stackRad, zPlanes, stackChannels, stackProfiles, stackCounts = stacks[(sceneName, roi.roi)]
+                rpe.writeStack(roiPath / Path("RadialStack.npz"), stackRad, zPlanes, stackProfiles, stackCounts,
+                               stackChannels, unit)
+            if (sceneName, roi.roi) in sectors:
+                sectorRad, sectorChannels, sectorProfiles, sectorCounts = sectors[(sceneName, roi.roi)]
+                rpe.writeSectors(roiPath / Path("RadialSectors.npz"), sectorRad, sectorProfiles, sectorCounts,
+                                 sectorChannels, unit)
+            if plots:
+                rpe.simplePlot(xRad, yRPs, channels, unit, roiPath / Path("RadialPlot.png"))
+
+            if peaks is not None:
+                # Channels without any peaks have no rows in the store
+                empty = (np.zeros(0), np.zeros(0), np.zeros(0))
+                roiPeaks = [peaks.get((sceneName, roi.roi), {}).get(channel, empty) for channel in channels]
+                peakPath = roiPath / Path("Peaks")
+                rpe.checkPath(peakPath)
+                for channel, (positions, relativePositions, heights) in zip(channels, roiPeaks):
+                    Peaks.writePeakTable(peakPath / Path(roiName + "_" + channel + "_Peaks.csv"), positions,
+                                         relativePositions, heights, unit, channels[0])
+                peakRows.append((channels, Peaks.peakInfoRow(roiName, roiPeaks)))
+
+        rpe.appendTableRows(tablePath, rows)
+        ROILoader.writeROIIndex(ROILoader.roiIndexPath(scenePath, sceneName), names, indexed)
+        if len(peakRows) != 0:
+            with open(scenePath / Path(sceneName + "_PeakInfo.csv"), "w") as f:
+                print(Peaks.peakInfoHeader(peakRows[0][0], unit), file=f)
+                for channels, row in peakRows:
+                    print(row, file=f)
@@ -0,0 +1,117 @@
+import argparse
+from pathlib import Path
+
+import AutoROIs
+import FindPeaks
+import ImageAccess
+import Peaks
+import ProfileOptions
+import RadialProfileEngine as rpe
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Run the radial profile analysis without Napari using previously defined ROIs.")
+    parser.add_argument("input", help="Image file to analyze")
+    parser.add_argument("output", help="Output directory. ROIs of a previous run are reloaded from here unless --rois is given.")
+    parser.add_argument("--rois", default=None, help="JSON or GeoJSON file containing ROIs and centers")
+    parser.add_argument("--scenes", nargs="+", default=None, help="Scene names to analyze (default: all)")
+    parser.add_argument("--channels", nargs="+", default=None, help="Channels to profile, e.g. Channel_1 (default: all)")
+    parser.add_argument("--pixel-size", type=float, default=None, help="Pixel size (default: read from the image)")
+    parser.add_argument("--unit", default=None, help="Distance unit (default: Microns if the image has a pixel size, otherwise Pixels)")
+    parser.add_argument("--max-intensity", action="store_true", help="Use a maximum intensity projection across Z")
+    parser.add_argument("--projection", choices=["max", "mean", "sum"], default=None, help="Project across Z with this projection instead of using a single Z-Plane")
+    parser.add_argument("--z-range", type=int, nargs=2, default=None, metavar=("START", "STOP"), help="Only project Z-Planes START to STOP - 1")
+    parser.add_argument("--threads", type=int, default=1, help="Threads used when projecting full planes")
+    parser.add_argument("--background-channels", nargs="+", default=[], help="Channels to background subtract")
+    parser.add_argument("--std-devs", type=float, default=0, help="Standard deviations above the mean to subtract")
+    parser.add_argument("--background-method", choices=["gaussian", "mad", "mode"], default="gaussian", help="Background estimator: Gaussian fit (default), median/MAD or histogram mode")
+    parser.add_argument("--background-step", type=int, default=1, help="Only use every n-th row and column to estimate the background")
+    parser.add_argument("--background-sample", type=int, default=None, help="Estimate the background from a random sample of this many pixels")
+    parser.add_argument("--output-format", choices=["tree", "parquet"], default="tree", help="Write a folder per ROI (tree) or consolidated Profiles.parquet and ROIs.parquet files (parquet)")
+    parser.add_argument("--no-plots", action="store_true", help="Do not draw RadialPlot.png for every ROI, plots can be drawn afterwards with RenderPlots.py")
+    parser.add_argument("--full", action="store_true", help="Profile every ROI again, even if it is unchanged since the last run into the output directory")
+    parser.add_argument("--timings", action="store_true", help="Write sceneName_Timings.json with the time spent in each stage, ROI counters and peak memory")
+    parser.add_argument("--trace-memory", action="store_true", help="With --timings, also record the peak memory allocated within each stage (slower)")
+    parser.add_argument("--cprofile", action="store_true", help="Write a cProfile dump of each scene to sceneName_Profile.prof")
+    parser.add_argument("--stack", action="store_true", help="Also profile every ROI at every timepoint and Z-Plane (within --z-range), written to RadialStack.npz")
+    parser.add_argument("--sectors", type=int, default=0, help="Also profile every ROI in this many angular sectors around its center, written to RadialSectors.npz")
+    parser.add_argument("--segment-channel", default=None, help="Derive ROIs automatically by thresholding this channel instead of loading them")
+    parser.add_argument("--labels", default=None, help="Derive ROIs automatically from a label image (or a folder of sceneName.tif label images)")
+    parser.add_argument("--threshold", default="otsu", help="Threshold of --segment-channel, a value or otsu (default)")
+    parser.add_argument("--center", choices=AutoROIs.CENTER_METHODS, default="centroid", help="Center of automatic ROIs: region centroid, intensity weighted centroid or brightest pixel")
+    parser.add_argument("--roi-shape", choices=AutoROIs.ROI_SHAPES, default="ellipse", help="Shape of automatic ROIs: equivalent ellipse or bounding box of each region")
+    parser.add_argument("--min-area", type=int, default=1, help="Ignore automatic regions with fewer pixels")
+    parser.add_argument("--segment-z", type=int, default=0, help="Z-Plane automatic ROIs are derived from and profiled on (ignored when projecting)")
+    parser.add_argument("--peaks", action="store_true", help="Find the peaks of every profile, see --prominence, --width and --smoothing")
+    FindPeaks.addPeakArgs(parser)
+    parser.add_argument("--image-backend", choices=ImageAccess.BACKENDS, default="auto", help="Open the image with aicsimageio or with tifffile's tiled access (auto: tifffile for tiled or pyramidal TIFFs)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used to profile ROIs")
+    parser.add_argument("--writer-threads", type=int, default=2, help="Threads writing the files of each ROI while the next ROIs are profiled (0: write them in the profiling thread)")
+    parser.add_argument("--tiff-compression", choices=rpe.TIFF_COMPRESSIONS, default=None, help="Compress the cropped ROI TIFFs")
+    args = parser.parse_args(argv)
+    if args.rois is not None and (args.segment_channel is not None or args.labels is not None):
+        parser.error("--rois cannot be combined with --segment-channel or --labels")
+    return args
+
+def main(argv=None):
+    args = parseArgs(argv)
+
+    path = Path(args.input)
+    image = ImageAccess.openImage(path, args.image_backend)
+    sceneDict = rpe.buildSceneDict(path, image)
+    channels = rpe.channelNames(image.dims.C)
+
+    # Same defaults as MainWindow.openFile
+    xScale = image.physical_pixel_sizes[2]
+    pixelSize = args.pixel_size if args.pixel_size is not None else (1.0 if xScale is None else xScale)
+    unit = args.unit if args.unit is not None else ("Pixels" if xScale is None else "Microns")
+
+    roiGenerator = None
+    if args.segment_channel is not None or args.labels is not None:
+        # Weighted and max centers are taken from the segmentation channel, or the first profiled channel
+        segmentChannel = args.segment_channel
+        if segmentChannel is None:
+            segmentChannel = args.channels[0] if args.channels is not None else channels[0]
+        roiGenerator = AutoROIs.ROIGenerator(segmentChannel,
+                                             labelPath=args.labels,
+                                             threshold=args.threshold,
+                                             center=args.center,
+                                             shape=args.roi_shape,
+                                             minArea=args.min_area,
+                                             z=args.segment_z)
+
+    profiler = rpe.HeadlessProfiler(image,
+                                    args.scenes if args.scenes is not None else list(sceneDict.keys()),
+                                    sceneDict,
+                                    channels,
+                                    args.channels if args.channels is not None else channels,
+                                    pixelSize,
+                                    unit,
+                                    imageOptions=ProfileOptions.ImageOptions(maxIntensity=args.max_intensity or args.projection is not None,
+                                                                             projection=args.projection if args.projection is not None else "max",
+                                                                             zRange=args.z_range,
+                                                                             threads=args.threads,
+                                                                             backend=args.image_backend),
+                                    backgroundOptions=ProfileOptions.BackgroundOptions(subtract=len(args.background_channels) != 0,
+                                                                                       channels=args.background_channels,
+                                                                                       stdDevs=args.std_devs,
+                                                                                       method=args.background_method,
+                                                                                       step=args.background_step,
+                                                                                       sampleSize=args.background_sample),
+                                    outputOptions=ProfileOptions.OutputOptions(format=args.output_format,
+                                                                               plots=not args.no_plots,
+                                                                               incremental=not args.full,
+                                                                               writerThreads=args.writer_threads,
+                                                                               tiffCompression=args.tiff_compression),
+                                    analysisOptions=ProfileOptions.AnalysisOptions(stack=args.stack,
+                                                                                   sectors=args.sectors,
+                                                                                   peakFinder=Peaks.PeakFinder(args.prominence, args.width, args.smoothing) if args.peaks else None),
+                                    instrumentationOptions=ProfileOptions.InstrumentationOptions(timings=args.timings,
+                                                                                                 traceMemory=args.trace_memory,
+                                                                                                 cProfile=args.cprofile),
+                                    workers=args.workers,
+                                    imagePath=path,
+                                    roiGenerator=roiGenerator)
+    profiler.executeScript(Path(args.output), args.rois)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,147 @@
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+
+import dask.array as da
+import tifffile
+import zarr
+
+
+DIMENSIONS = "TCZYX"
+
+Dimensions = namedtuple("Dimensions", list(DIMENSIONS))
+PhysicalPixelSizes = namedtuple("PhysicalPixelSizes", ["Z", "Y", "X"])
+
+
+def toTCZYX(array, axes):
+    """
+    Reorders a dask array with tifffile axes (e.g. "YX", "CYX", "TZCYX", "YXS") into TCZYX, adding missing
+    dimensions of size 1. RGB samples are used as channels, other axes as Z or T if those are missing.
+    """
+    axes = list(axes)
+    if "S" in axes and "C" not in axes:
+        axes[axes.index("S")] = "C"
+    for index, axis in enumerate(axes):
+        if axis in DIMENSIONS:
+            continue
+        if array.shape[index] == 1:
+            array = array[tuple(0 if i == index else slice(None) for i in range(array.ndim))]
+            axes[index] = None
+            continue
+        missing = [dimension for dimension in "ZT" if dimension not in axes]
+        if len(missing) == 0:
+            raise ValueError("Unsupported TIFF axes: " + "".join(str(axis) for axis in axes))
+        axes[index] = missing[0]
+    axes = [axis for axis in axes if axis is not None]
+
+    for dimension in DIMENSIONS:
+        if dimension not in axes:
+            array = array[None]
+            axes.insert(0, dimension)
+    return array.transpose([axes.index(dimension) for dimension in DIMENSIONS])
+
+
+class TiledImage:
+    """
+    TIFF reader for slide-scale images that do not fit in memory, used in place of an AICSImage.
+    Every resolution level of a scene is a dask array backed by tifffile's zarr interface, so reading a region
+    only decodes the tiles (or strips) it touches. Only the parts of AICSImage used by the radial profile
+    scripts are provided: scenes, set_scene, dask_data, dims and physical_pixel_sizes.
+    Each TIFF series (e.g. each OME image) is a scene, and pyramid levels stored in the file are used for the viewer.
+    The file stays open until close is called, or the image is used as a context manager.
+    Inputs:
+        - path -> Path of a TIFF / OME-TIFF file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tiff = tifffile.TiffFile(path)
+        self.series = self.tiff.series
+        self.scenes = tuple("Image:" + str(index) for index in range(len(self.series)))
+        self.sceneIndex = 0
+        self.pixelSizes = self.omePixelSizes()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the TIFF file, dask arrays of the image can no longer be computed afterwards.
+        """
+        self.tiff.close()
+
+    def omePixelSizes(self):
+        """
+        Physical pixel sizes of every scene from the OME or ImageJ metadata (None for files without either).
+        """
+        sizes = [PhysicalPixelSizes(None, None, None) for _ in self.series]
+        if self.tiff.is_imagej:
+            return [self.imagejPixelSize()] * len(sizes)
+        if not self.tiff.is_ome:
+            return sizes
+        try:
+            root = ElementTree.fromstring(self.tiff.ome_metadata)
+        except ElementTree.ParseError:
+            return sizes
+        pixels = [element for element in root.iter() if element.tag.endswith("}Pixels")]
+        for index, element in enumerate(pixels[:len(sizes)]):
+            sizes[index] = PhysicalPixelSizes(*[float(element.get(name)) if element.get(name) is not None else None
+                                                for name in ("PhysicalSizeZ", "PhysicalSizeY", "PhysicalSizeX")])
+        return sizes
+
+    def imagejPixelSize(self):
+        """
+        Pixel size of an ImageJ TIFF, from the resolution tags of the first page and the slice spacing.
+        """
+        tags = self.tiff.pages[0].tags
+        sizes = []
+        for name in ("YResolution", "XResolution"):
+            tag = tags.get(name)
+            numerator, denominator = tag.value if tag is not None else (0, 0)
+            sizes.append(denominator / numerator if numerator != 0 else None)
+        spacing = (self.tiff.imagej_metadata or {}).get("spacing")
+        return PhysicalPixelSizes(None if spacing is None else float(spacing), *sizes)
+
+    def set_scene(self, index):
+        self.sceneIndex = index
+
+    @property
+    def current_scene(self):
+        return self.scenes[self.sceneIndex]
+
+    def level(self, level):
+        """
+        TCZYX dask array of a resolution level of the current scene, nothing is read until it is computed.
+        """
+        series = self.series[self.sceneIndex]
+        array = da.from_zarr(zarr.open(series.aszarr(level=level), mode="r"))
+        return toTCZYX(array, series.levels[level].axes)
+
+    @property
+    def dask_data(self):
+        return self.level(0)
+
+    @property
+    def dask_levels(self):
+        """
+        Every resolution level stored for the current scene, full resolution first.
+        """
+        return [self.level(level) for level in range(len(self.series[self.sceneIndex].levels))]
+
+    @property
+    def dims(self):
+        return Dimensions(*self.dask_data.shape)
+
+    @property
+    def physical_pixel_sizes(self):
+        return self.pixelSizes[self.sceneIndex]
+
+
+def isTiled(path):
+    """
+    True if a TIFF is stored in tiles or holds several resolution levels, i.e. was written for tiled access.
+    """
+    with tifffile.TiffFile(path) as tiff:
+        return any(page.is_tiled for page in tiff.pages[:1]) or any(len(series.levels) > 1 for series in tiff.series)